@@ -1,13 +1,18 @@
+import datetime
+
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.admin import SimpleListFilter
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import PermissionDenied
 from django.http import HttpResponseRedirect
+from django.template.response import TemplateResponse
 from django.templatetags.static import static
-from django.urls import reverse
+from django.urls import path, reverse
+from django.utils import timezone
 from django.utils.safestring import mark_safe
 
-from report_builder.models import Format, Report
+from report_builder.models import Format, Report, ReportRun, ReportSummary
 
 
 class StarredFilter(SimpleListFilter):
@@ -39,7 +44,7 @@ class ReportAdmin(admin.ModelAdmin):
     readonly_fields = [
         'slug',
     ]
-    fields = ['name', 'description', 'root_model', 'slug']
+    fields = ['name', 'description', 'root_model', 'slug', 'statement_timeout', 'database', 'freshness_field']
     search_fields = ('name', 'description')
     list_filter = (StarredFilter, 'root_model', 'created', 'modified', 'root_model__app_label')
     list_display_links = []
@@ -67,15 +72,16 @@ class ReportAdmin(admin.ModelAdmin):
             self.fields += ['report_file', 'report_file_creation']
         return super().change_view(request, object_id, extra_context=None)
 
-    def changelist_view(self, request, extra_context=None):
-        self.user = request.user
-        return super().changelist_view(request, extra_context=extra_context)
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request).select_related('root_model', 'user_created')
+        return queryset.annotate(is_starred=Report.starred_by(request.user))
 
     @admin.display(
         description="Starred",
+        ordering="is_starred",
     )
     def ajax_starred(self, obj):
-        if obj.starred.filter(id=self.user.id):
+        if obj.is_starred:
             img = static('report_builder/img/star.png')
         else:
             img = static('report_builder/img/unstar.png')
@@ -104,6 +110,63 @@ class FormatAdmin(admin.ModelAdmin):
     pass
 
 
+@admin.register(ReportSummary)
+class ReportSummaryAdmin(admin.ModelAdmin):
+    list_display = ('report', 'watermark_field', 'watermark', 'refreshed')
+    readonly_fields = ('watermark', 'refreshed')
+
+
+@admin.register(ReportRun)
+class ReportRunAdmin(admin.ModelAdmin):
+    list_display = (
+        'report',
+        'trigger',
+        'status',
+        'duration',
+        'row_count',
+        'byte_count',
+        'query_count',
+        'user',
+        'created',
+    )
+    list_filter = ('status', 'trigger', 'created')
+    list_select_related = ('report', 'user')
+    search_fields = ('report__name',)
+    readonly_fields = [field.name for field in ReportRun._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        return [
+            path(
+                'stats/',
+                self.admin_site.admin_view(self.stats_view),
+                name='report_builder_reportrun_stats',
+            ),
+            *super().get_urls(),
+        ]
+
+    def stats_view(self, request):
+        """Duration percentiles per report over the last days, to find the
+        reports that load the database the most
+        """
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        try:
+            days = int(request.GET.get('days', getattr(settings, 'REPORT_BUILDER_RUN_STATS_DAYS', 30)))
+        except ValueError:
+            days = 30
+        context = {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': f'Report run times, last {days} days',
+            'days': days,
+            'stats': ReportRun.get_stats(since=timezone.now() - datetime.timedelta(days=days)),
+        }
+        return TemplateResponse(request, 'admin/report_builder/reportrun/stats.html', context)
+
+
 def export_to_report(modeladmin, request, queryset):
     admin_url = request.get_full_path()
     selected_int = queryset.values_list('id', flat=True)
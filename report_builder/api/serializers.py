@@ -6,6 +6,7 @@ from django.db import transaction
 from rest_framework import serializers
 
 from report_builder.models import DisplayField, FilterField, Format, Report
+from report_builder.registry import get_allowed_model_keys
 
 
 User = get_user_model()
@@ -92,19 +93,69 @@ class ContentTypeSerializer(serializers.ModelSerializer):
         fields = ("pk", "name")
 
 
+class AllowedModelField(serializers.PrimaryKeyRelatedField):
+    """Content type of a model reports may use, read when validating"""
+
+    def get_queryset(self):
+        return Report.allowed_models()
+
+    def to_internal_value(self, data):
+        # Checked against the cached allowed pks, content types are cached too
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        if pk not in get_allowed_model_keys()[1]:
+            self.fail('does_not_exist', pk_value=data)
+        try:
+            return ContentType.objects.get_for_id(pk)
+        except ContentType.DoesNotExist:
+            self.fail('does_not_exist', pk_value=data)
+
+
 class ReportSerializer(serializers.HyperlinkedModelSerializer):
-    root_model = serializers.PrimaryKeyRelatedField(queryset=Report.allowed_models())
+    root_model = AllowedModelField(queryset=ContentType.objects.all())
     root_model_name = serializers.StringRelatedField(source='root_model')
     user_created = UserSerializer(read_only=True)
+    is_starred = serializers.SerializerMethodField()
 
     class Meta:
         model = Report
-        fields = ('id', 'name', 'modified', 'root_model', 'root_model_name', 'user_created')
+        fields = ('id', 'name', 'modified', 'root_model', 'root_model_name', 'user_created', 'is_starred')
+
+    def get_is_starred(self, obj):
+        # Annotated by list querysets, see Report.starred_by
+        if hasattr(obj, 'is_starred'):
+            return obj.is_starred
+        request = self.context.get('request')
+        return request is not None and obj.starred.filter(pk=request.user.pk).exists()
+
+
+class NestedDisplayFieldSerializer(DisplayFieldSerializer):
+    """Display field within a report. id picks the row to update and the
+    report is always the parent.
+    """
+
+    id = serializers.IntegerField(required=False)
+
+    class Meta(DisplayFieldSerializer.Meta):
+        read_only_fields = ('report',)
+
+
+class NestedFilterFieldSerializer(FilterFieldSerializer):
+    """Filter field within a report, see NestedDisplayFieldSerializer"""
+
+    id = serializers.IntegerField(required=False)
+
+    class Meta(FilterFieldSerializer.Meta):
+        read_only_fields = ('field_type', 'report')
 
 
 class ReportNestedSerializer(ReportSerializer):
-    displayfield_set = DisplayFieldSerializer(required=False, many=True)
-    filterfield_set = FilterFieldSerializer(required=False, many=True)
+    displayfield_set = NestedDisplayFieldSerializer(required=False, many=True)
+    filterfield_set = NestedFilterFieldSerializer(required=False, many=True)
     user_created = serializers.PrimaryKeyRelatedField(read_only=True)
     user_modified = serializers.PrimaryKeyRelatedField(read_only=True)
 
@@ -129,8 +180,10 @@ class ReportNestedSerializer(ReportSerializer):
 
     def validate(self, data):
         if 'filterfield_set' in data:
+            # Filters are cleaned against the report's root model
+            report = Report(root_model=data['root_model']) if 'root_model' in data else self.instance
             for filter_field_data in data['filterfield_set']:
-                filter_field = FilterField()
+                filter_field = FilterField(report=report)
                 for key, value in filter_field_data.items():
                     setattr(filter_field, key, value)
                 filter_field.clean()
@@ -138,8 +191,8 @@ class ReportNestedSerializer(ReportSerializer):
         return data
 
     def update(self, instance, validated_data):
-        displayfields_data = validated_data.pop('displayfield_set')
-        filterfields_data = validated_data.pop('filterfield_set')
+        displayfields_data = validated_data.pop('displayfield_set', None)
+        filterfields_data = validated_data.pop('filterfield_set', None)
 
         with transaction.atomic():
             instance.name = validated_data.get('name', instance.name)
@@ -147,16 +200,71 @@ class ReportNestedSerializer(ReportSerializer):
             instance.distinct = validated_data.get('distinct', instance.distinct)
             instance.modified = datetime.date.today()
             instance.save()
-            instance.displayfield_set.all().delete()
-            for displayfield_data in displayfields_data:
-                display_field = DisplayField()
-                for key, value in displayfield_data.items():
-                    setattr(display_field, key, value)
-                display_field.save()
-            instance.filterfield_set.all().delete()
-            for filterfield_data in filterfields_data:
-                filter_field = FilterField()
-                for key, value in filterfield_data.items():
-                    setattr(filter_field, key, value)
-                filter_field.save()
+            if displayfields_data is not None:
+                self.update_fields(instance, DisplayField, displayfields_data)
+            if filterfields_data is not None:
+                self.update_fields(instance, FilterField, filterfields_data)
         return instance
+
+    def update_fields(self, instance, model, fields_data):
+        """Make the report's display or filter fields match fields_data.
+        Rows are matched by id, so only changed rows are written: one
+        delete, one bulk insert and one bulk update at most.
+        """
+        existing = {field.pk: field for field in model.objects.filter(report=instance)}
+        # Relations are compared by id, reading them would query every row
+        attnames = {field.name: field.attname for field in model._meta.concrete_fields if field.is_relation}
+        new_fields = []
+        changed_fields = []
+        changed_names = set()
+        for field_data in fields_data:
+            field_data = dict(field_data)
+            field = existing.pop(field_data.pop('id', None), None)
+            if field is None:
+                new_fields.append(model(report=instance, **field_data))
+                continue
+            changed = [
+                key
+                for key, value in field_data.items()
+                if (
+                    getattr(field, attnames[key]) != getattr(value, 'pk', value)
+                    if key in attnames
+                    else getattr(field, key) != value
+                )
+            ]
+            for key in changed:
+                setattr(field, key, field_data[key])
+            if changed:
+                changed_fields.append(field)
+                changed_names.update(changed)
+        if existing:
+            model.objects.filter(pk__in=existing).delete()
+        if new_fields:
+            model.objects.bulk_create(new_fields)
+        if changed_fields:
+            model.objects.bulk_update(changed_fields, sorted(changed_names))
+
+
+class ReportPreviewSerializer(ReportNestedSerializer):
+    """Report definition to run without saving it, see get_report"""
+
+    class Meta(ReportNestedSerializer.Meta):
+        fields = ('root_model', 'distinct', 'displayfield_set', 'filterfield_set')
+
+    def get_report(self):
+        """Unsaved report using the unsaved fields, numbered by position"""
+        data = dict(self.validated_data)
+        displayfields_data = data.pop('displayfield_set', [])
+        filterfields_data = data.pop('filterfield_set', [])
+        report = Report(name='Preview', **data)
+        fields = []
+        for model, fields_data in ((DisplayField, displayfields_data), (FilterField, filterfields_data)):
+            fields_data = sorted(fields_data, key=lambda field: (field.get('position') is None, field.get('position')))
+            fields.append(
+                [
+                    model(report=report, **dict(field_data, id=None, position=position))
+                    for position, field_data in enumerate(fields_data)
+                ],
+            )
+        report.use_fields(*fields)
+        return report
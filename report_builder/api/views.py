@@ -1,35 +1,47 @@
-import copy
+import hashlib
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.http import JsonResponse
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import DEFAULT_DB_ALIAS, connections, router
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.utils.functional import cached_property
-from rest_framework import viewsets
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework import exceptions, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.filters import SearchFilter
+from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAdminUser
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
 from ..mixins import DataExportMixin, GetFieldsMixin
-from ..models import FilterField, Format, Report, get_allowed_models
-from ..utils import duplicate
+from ..models import FilterField, Format, Report, ReportRun, get_allowed_models
+from ..registry import get_field_tree, get_model_info, get_schema_version, is_included
+from ..utils import (
+    ReportTimeoutError,
+    export_snapshot,
+    not_modified_response,
+    set_freshness_headers,
+    use_snapshot,
+)
 from .serializers import (
     ContentTypeSerializer,
     FilterFieldSerializer,
     FormatSerializer,
     ReportNestedSerializer,
+    ReportPreviewSerializer,
     ReportSerializer,
 )
 
 
-def find_exact_position(fields_list, item):
-    current_position = 0
-    for i in fields_list:
-        if i.name == item.name and i.get_internal_type() == item.get_internal_type():
-            return current_position
-        current_position += 1
-    return -1
+logger = logging.getLogger(__name__)
 
 
 class ReportBuilderViewMixin:
@@ -41,7 +53,67 @@ class ReportBuilderViewMixin:
     pagination_class = None
 
 
-class ConfigView(ReportBuilderViewMixin, APIView):
+class NotModified(exceptions.APIException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+
+
+class SchemaETagMixin:
+    """Conditional GET for metadata that only changes with the schema.
+    GET responses carry an ETag and a matching If-None-Match returns 304
+    without building the response.
+    """
+
+    def get_etag_parts(self, request):
+        return [
+            get_schema_version(),
+            getattr(settings, 'REPORT_BUILDER_INCLUDE', None),
+            getattr(settings, 'REPORT_BUILDER_EXCLUDE', None),
+            request.path,
+            sorted(request.query_params.lists()),
+        ]
+
+    def get_etag(self, request):
+        digest = hashlib.sha256(repr(self.get_etag_parts(request)).encode()).hexdigest()
+        return f'"{digest}"'
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.etag = None
+        if request.method in ('GET', 'HEAD'):
+            self.etag = self.get_etag(request)
+            if_none_match = request.headers.get('If-None-Match')
+            if if_none_match:
+                etags = [etag.removeprefix('W/') for etag in parse_etags(if_none_match)]
+                if self.etag in etags or '*' in etags:
+                    raise NotModified()
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return Response(status=status.HTTP_304_NOT_MODIFIED)
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) and response.status_code in (200, 304):
+            response['ETag'] = self.etag
+            patch_cache_control(
+                response,
+                private=True,
+                max_age=getattr(settings, 'REPORT_BUILDER_METADATA_MAX_AGE', 0),
+                must_revalidate=True,
+            )
+            patch_vary_headers(response, ('Cookie', 'Authorization'))
+        return response
+
+
+class ConfigView(ReportBuilderViewMixin, SchemaETagMixin, APIView):
+    def get_etag_parts(self, request):
+        formats = Format.objects.order_by('pk').values_list('pk', 'name', 'string')
+        return super().get_etag_parts(request) + [
+            getattr(settings, 'REPORT_BUILDER_ASYNC_REPORT', False),
+            list(formats),
+        ]
+
     def get(self, request):
         data = {
             'async_report': getattr(settings, 'REPORT_BUILDER_ASYNC_REPORT', False),
@@ -60,24 +132,54 @@ class FilterFieldViewSet(ReportBuilderViewMixin, viewsets.ModelViewSet):
     serializer_class = FilterFieldSerializer
 
 
-class ContentTypeViewSet(ReportBuilderViewMixin, viewsets.ReadOnlyModelViewSet):
+class ContentTypeViewSet(ReportBuilderViewMixin, SchemaETagMixin, viewsets.ReadOnlyModelViewSet):
     """Read only view of content types.
     Used to populate choices for new report root model.
     """
 
-    queryset = get_allowed_models()
+    queryset = ContentType.objects.all()
     serializer_class = ContentTypeSerializer
 
+    def get_queryset(self):
+        return get_allowed_models()
+
+
+class ReportPagination(PageNumberPagination):
+    """Opt in paging of the report list with ?page_size=, or for every
+    request with REPORT_BUILDER_REPORTS_PAGE_SIZE. Unpaged otherwise.
+    """
+
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        self.page_size = getattr(settings, 'REPORT_BUILDER_REPORTS_PAGE_SIZE', None)
+        return super().get_page_size(request)
+
 
 class ReportViewSet(ReportBuilderViewMixin, viewsets.ModelViewSet):
     queryset = Report.objects.all()
     serializer_class = ReportSerializer
+    pagination_class = ReportPagination
+    filter_backends = (SearchFilter,)
+    search_fields = ('name', 'description')
+
+    def get_queryset(self):
+        queryset = super().get_queryset().select_related('root_model', 'user_created')
+        # Pages need a stable order, pk breaks ties between equal names
+        queryset = queryset.order_by('name', 'pk')
+        return queryset.annotate(is_starred=Report.starred_by(self.request.user))
 
 
 class ReportNestedViewSet(ReportBuilderViewMixin, viewsets.ModelViewSet):
     queryset = Report.objects.all()
     serializer_class = ReportNestedSerializer
 
+    def get_queryset(self):
+        # Prefetched fields share the report, and so its root model
+        queryset = super().get_queryset().select_related('root_model')
+        return queryset.prefetch_related('displayfield_set', 'filterfield_set')
+
     def perform_create(self, serializer):
         serializer.save(user_created=self.request.user)
 
@@ -87,93 +189,56 @@ class ReportNestedViewSet(ReportBuilderViewMixin, viewsets.ModelViewSet):
     @action(methods=['post'], detail=True)
     def copy_report(self, request, pk=None):
         report = self.get_object()
-        new_report = duplicate(
-            report,
-            changes=(
-                ('name', f'{report.name} (copy)'),
-                ('user_created', request.user),
-                ('user_modified', request.user),
-            ),
+        new_report = report.clone(
+            name=f'{report.name} (copy)',
+            user_created=request.user,
+            user_modified=request.user,
         )
-
-        # duplicate does not get related
-        for display in report.displayfield_set.all():
-            new_display = copy.copy(display)
-            new_display.pk = None
-            new_display.report = new_report
-            new_display.save()
-        for report_filter in report.filterfield_set.all():
-            new_filter = copy.copy(report_filter)
-            new_filter.pk = None
-            new_filter.report = new_report
-            new_filter.save()
-
         serializer = ReportNestedSerializer(new_report)
         return JsonResponse(serializer.data)
 
 
-class RelatedFieldsView(ReportBuilderViewMixin, GetFieldsMixin, APIView):
-    """Get related fields from an ORM model"""
+class RelatedFieldsView(ReportBuilderViewMixin, SchemaETagMixin, GetFieldsMixin, APIView):
+    """Get related fields from an ORM model.
+    Accepts the same parameters as query parameters on GET, which can be cached.
+    """
 
     def get_data_from_request(self, request):
-        self.model = request.data['model']
-        self.path = request.data['path']
-        self.path_verbose = request.data.get('path_verbose', '')
-        self.field = request.data['field']
+        data = request.query_params if request.method in ('GET', 'HEAD') else request.data
+        self.model = data['model']
+        self.path = data.get('path', '')
+        self.path_verbose = data.get('path_verbose', '')
+        self.field = data.get('field', '')
         self.model_class = ContentType.objects.get(pk=self.model).model_class()
 
+    def get(self, request):
+        return self.post(request)
+
     def post(self, request):
         self.get_data_from_request(request)
-        new_fields, model_ct, path = self.get_related_fields(
-            self.model_class,
-            self.field,
-            self.path,
-            self.path_verbose,
-        )
+        new_model, path = self.get_related_model(self.model_class, self.field, self.path)
+        model_ct = ContentType.objects.get_for_model(new_model)
         result = []
-        for new_field in new_fields:
-            included_model = True
-            split_name = new_field.name.split(':')
-            if len(split_name) == 1:
-                split_name.append('')
-                split_name[1] = split_name[0]
-                split_name[0] = False
-                model_information = split_name[1]
-            else:
-                model_information = split_name[0] + "." + split_name[1]
-            app_label = split_name[0]
-            model_name = split_name[1]
-            if getattr(settings, 'REPORT_BUILDER_INCLUDE', False):
-                includes = settings.REPORT_BUILDER_INCLUDE
-                # If it is not included as 'foo' and not as 'demo_models.foo'
-                if model_name not in includes and model_information not in includes:
-                    included_model = False
-            if getattr(settings, 'REPORT_BUILDER_EXCLUDE', False):
-                excludes = settings.REPORT_BUILDER_EXCLUDE
-                # If it is excluded as 'foo' and as 'demo_models.foo'
-                if model_name in excludes or model_information in excludes:
-                    included_model = False
-            verbose_name = getattr(new_field, 'verbose_name', None)
-            if verbose_name is None:
-                verbose_name = new_field.get_accessor_name()
-            result += [
-                {
-                    'field_name': new_field.field_name,
-                    'verbose_name': verbose_name,
-                    'path': path,
-                    'help_text': getattr(new_field, 'help_text', ''),
-                    'model_id': model_ct.id,
-                    'parent_model_name': model_name,
-                    'parent_model_app_label': app_label,
-                    'included_model': included_model,
-                },
-            ]
+        for row in get_model_info(new_model).relation_rows:
+            row = dict(row, path=path, model_id=model_ct.id)
+            row['included_model'] = is_included(row['parent_model_name'], row.pop('model_information'))
+            result.append(row)
         return Response(result)
 
 
 class FieldsView(RelatedFieldsView):
     """Get direct fields and properties on an ORM model"""
 
+    def get_etag_parts(self, request):
+        parts = super().get_etag_parts(request)
+        if 'custom_field' in settings.INSTALLED_APPS:
+            from custom_field.models import CustomField
+
+            # Custom fields are stored in the database
+            custom_fields = CustomField.objects.order_by('pk')
+            parts.append(list(custom_fields.values_list('pk', 'content_type', 'name', 'field_type', 'field_choices')))
+        return parts
+
     def post(self, request):
         self.get_data_from_request(request)
         field_data = self.get_fields(
@@ -182,95 +247,13 @@ class FieldsView(RelatedFieldsView):
             self.path,
             self.path_verbose,
         )
+        path = field_data['path']
+        path_verbose = field_data['path_verbose']
+        info = get_model_info(field_data['model'])
+        result = [dict(row, path=path, path_verbose=path_verbose) for row in info.field_rows]
 
-        # External packages might cause duplicates. This clears it up
-        new_set = []
-        for i in field_data['fields']:
-            if i not in new_set:
-                new_set.append(i)
-        field_data['fields'] = new_set
-
-        result = []
-        fields = None
-        filters = None
-        extra = None
-        defaults = None
-        meta = getattr(field_data['model'], 'ReportBuilder', None)
-        if meta is not None:
-            fields = getattr(meta, 'fields', None)
-            filters = getattr(meta, 'filters', None)
-            exclude = getattr(meta, 'exclude', None)
-            extra = getattr(meta, 'extra', None)
-            defaults = getattr(meta, 'defaults', None)
-            if fields is not None:
-                fields = list(fields)
-                for field in copy.copy(field_data['fields']):
-                    if field.name not in fields:
-                        index = find_exact_position(
-                            field_data['fields'],
-                            field,
-                        )
-                        if index != -1:
-                            field_data['fields'].pop(index)
-            if exclude is not None:
-                for field in copy.copy(field_data['fields']):
-                    if field.name in exclude:
-                        index = find_exact_position(
-                            field_data['fields'],
-                            field,
-                        )
-                        if index != -1:
-                            field_data['fields'].pop(index)
-            if extra is not None:
-                extra = list(extra)
-
-        for new_field in field_data['fields']:
-            verbose_name = getattr(new_field, 'verbose_name', None)
-            if not verbose_name:
-                verbose_name = new_field.get_accessor_name()
-            result += [
-                {
-                    'name': new_field.name,
-                    'field': new_field.name,
-                    'field_verbose': verbose_name,
-                    'field_type': new_field.get_internal_type(),
-                    'is_default': True if defaults is None or new_field.name in defaults else False,
-                    'field_choices': new_field.choices,
-                    'can_filter': True if filters is None or new_field.name in filters else False,
-                    'path': field_data['path'],
-                    'path_verbose': field_data['path_verbose'],
-                    'help_text': new_field.help_text,
-                },
-            ]
-        # Add properties
-        if fields is not None or extra is not None:
-            if fields and extra:
-                extra_fields = list(set(fields + extra))
-            elif fields is not None:
-                extra_fields = fields
-            else:
-                extra_fields = extra
-            for field in extra_fields:
-                field_attr = getattr(field_data['model'], field, None)
-                if isinstance(field_attr, property | cached_property):
-                    result += [
-                        {
-                            'name': field,
-                            'field': field,
-                            'field_verbose': field,
-                            'field_type': 'Property',
-                            'field_choices': None,
-                            'can_filter': True if filters is None or field in filters else False,
-                            'path': field_data['path'],
-                            'path_verbose': field_data['path_verbose'],
-                            'is_default': True if defaults is None or field in defaults else False,
-                            'help_text': 'Adding this property will '
-                            'significantly increase the time it takes to run a '
-                            'report.',
-                        },
-                    ]
         # Add custom fields
-        custom_fields = field_data.get('custom_fields', None)
+        custom_fields = field_data['custom_fields']
         if custom_fields:
             for field in custom_fields:
                 result += [
@@ -280,31 +263,293 @@ class FieldsView(RelatedFieldsView):
                         'field_verbose': field.name,
                         'field_type': 'Custom Field',
                         'field_choices': getattr(field, 'choices', None),
-                        'can_filter': True if filters is None or field.name in filters else False,
-                        'path': field_data['path'],
-                        'path_verbose': field_data['path_verbose'],
-                        'is_default': True if defaults is None or field.name in defaults else False,
+                        'can_filter': info.can_filter(field.name),
+                        'path': path,
+                        'path_verbose': path_verbose,
+                        'is_default': info.is_default(field.name),
                         'help_text': 'This is a custom field.',
                     },
                 ]
         return Response(result)
 
 
+class FieldTreeView(ReportBuilderViewMixin, SchemaETagMixin, APIView):
+    """Get the fields and relations reachable from a model in one request.
+    depth is the number of relation levels to expand, capped by
+    REPORT_BUILDER_FIELD_TREE_MAX_DEPTH. Custom fields are not included.
+    """
+
+    def get(self, request):
+        try:
+            model = int(request.query_params['model'])
+            depth = int(request.query_params.get('depth', 1))
+        except (KeyError, ValueError):
+            return Response({'detail': 'model and depth must be numbers.'}, status=status.HTTP_400_BAD_REQUEST)
+        model_class = get_object_or_404(ContentType, pk=model).model_class()
+        max_depth = getattr(settings, 'REPORT_BUILDER_FIELD_TREE_MAX_DEPTH', 3)
+        depth = min(max(depth, 0), max_depth)
+        return Response(get_field_tree(model_class, depth))
+
+
 class GenerateReport(ReportBuilderViewMixin, DataExportMixin, APIView):
     def get(self, request, report_id=None):
         return self.post(request, report_id=report_id)
 
     def post(self, request, report_id=None):
         report = get_object_or_404(Report, pk=report_id)
+        if 'cursor' in request.query_params or 'page_size' in request.query_params:
+            return self.get_page(request, report)
+
+        freshness = None
+        try:
+            if request.method == 'GET':
+                freshness = report.get_freshness('preview', request.user)
+                not_modified = freshness and not_modified_response(request, freshness)
+                if not_modified:
+                    return not_modified
+            with report.track_run(ReportRun.PREVIEW, request.user), report.limit_execution():
+                objects_list = report.report_to_list(
+                    user=request.user,
+                    preview=True,
+                )
+        except ReportTimeoutError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+        display_fields = [display_field.name for display_field in report.get_good_display_fields()]
+        response = Response(
+            {
+                'data': objects_list,
+                'meta': {'titles': display_fields},
+            },
+        )
+        if freshness:
+            set_freshness_headers(response, freshness)
+        return response
+
+    def get_page(self, request, report):
+        """Keyset paginated preview, see Report.get_keyset_page"""
+        max_page_size = getattr(settings, 'REPORT_BUILDER_PREVIEW_MAX_PAGE_SIZE', 1000)
+        try:
+            page_size = int(request.query_params.get('page_size', 50))
+        except ValueError:
+            return Response({'detail': 'page_size must be a number.'}, status=status.HTTP_400_BAD_REQUEST)
+        page_size = min(max(page_size, 1), max_page_size)
+        try:
+            with report.track_run(ReportRun.PREVIEW, request.user) as metrics, report.limit_execution():
+                objects_list, next_cursor = report.get_keyset_page(
+                    cursor=request.query_params.get('cursor'),
+                    page_size=page_size,
+                )
+                metrics.row_count = len(objects_list)
+        except ReportTimeoutError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        display_fields = [display_field.name for display_field in report.get_good_display_fields()]
+        return Response(
+            {
+                'data': objects_list,
+                'meta': {'titles': display_fields},
+                'next': next_cursor,
+            },
+        )
 
-        objects_list = report.report_to_list(
-            user=request.user,
-            preview=True,
+
+class GenerateReports(ReportBuilderViewMixin, APIView):
+    """Run the previews of several reports at once, e.g. for a dashboard.
+    Reports run on a pool of REPORT_BUILDER_BATCH_WORKERS threads, each with
+    its own database connection. With snapshot, reports on PostgreSQL all
+    read the same repeatable read snapshot.
+    """
+
+    def post(self, request):
+        try:
+            report_ids = list(dict.fromkeys(int(pk) for pk in request.data['reports']))
+        except (KeyError, TypeError, ValueError):
+            return Response({'detail': 'reports must be a list of report ids.'}, status=status.HTTP_400_BAD_REQUEST)
+        max_reports = getattr(settings, 'REPORT_BUILDER_BATCH_MAX_REPORTS', 50)
+        if len(report_ids) > max_reports:
+            return Response(
+                {'detail': f'At most {max_reports} reports can run at once.'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        reports = Report.objects.select_related('root_model').in_bulk(report_ids)
+        snapshot_using = getattr(settings, 'REPORT_BUILDER_DATABASE', None) or DEFAULT_DB_ALIAS
+        workers = min(getattr(settings, 'REPORT_BUILDER_BATCH_WORKERS', 4), len(report_ids))
+        started = time.monotonic()
+        with export_snapshot(snapshot_using) if request.data.get('snapshot') else nullcontext() as snapshot:
+
+            def run(report_id):
+                return self.run_report(reports.get(report_id), request.user, snapshot, snapshot_using, workers > 1)
+
+            if workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    results = list(executor.map(run, report_ids))
+            else:
+                results = [run(report_id) for report_id in report_ids]
+        return Response(
+            {
+                'results': {str(report_id): result for report_id, result in zip(report_ids, results, strict=True)},
+                'snapshot': snapshot is not None,
+                'elapsed': round(time.monotonic() - started, 3),
+            },
         )
-        display_fields = report.get_good_display_fields().values_list('name', flat=True)
-        response = {
-            'data': objects_list,
-            'meta': {'titles': display_fields},
-        }
 
-        return Response(response)
+    def run_report(self, report, user, snapshot, snapshot_using, threaded):
+        """Preview one report, as GenerateReport does"""
+        if report is None:
+            return {'status': status.HTTP_404_NOT_FOUND, 'detail': 'Not found.'}
+        started = time.monotonic()
+        using = report.get_database() or router.db_for_read(report.root_model_class)
+        try:
+            # Without threads the report runs on the exporting connection, already in the snapshot
+            import_snapshot = snapshot if threaded and using == snapshot_using else None
+            with use_snapshot(import_snapshot, using=using):
+                # Memory tracing is process wide, it can not tell the workers apart
+                with report.track_run(ReportRun.PREVIEW, user, trace_memory=not threaded), report.limit_execution():
+                    objects_list = report.report_to_list(user=user, preview=True)
+            result = {
+                'status': status.HTTP_200_OK,
+                'data': objects_list,
+                'meta': {'titles': [display_field.name for display_field in report.get_good_display_fields()]},
+            }
+        except ReportTimeoutError as e:
+            result = {'status': status.HTTP_504_GATEWAY_TIMEOUT, 'detail': str(e)}
+        except Exception:
+            # One broken report must not fail the others, its run is recorded as an error
+            logger.exception('Report %s failed in a batch', report.pk)
+            result = {'status': status.HTTP_500_INTERNAL_SERVER_ERROR, 'detail': 'The report failed.'}
+        finally:
+            if threaded:
+                # Worker threads open their own connections
+                connections.close_all()
+        result['elapsed'] = round(time.monotonic() - started, 3)
+        return result
+
+
+class PreviewReport(ReportBuilderViewMixin, APIView):
+    """Run an unsaved report definition with the preview limits.
+    Accepts root_model, distinct, displayfield_set and filterfield_set as
+    in the nested report format. Nothing is written to the database.
+    """
+
+    def post(self, request):
+        serializer = ReportPreviewSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        report = serializer.get_report()
+        try:
+            with report.limit_execution():
+                objects_list = report.report_to_list(
+                    user=request.user,
+                    preview=True,
+                )
+        except ReportTimeoutError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+        display_fields = [display_field.name for display_field in report.get_good_display_fields()]
+        return Response(
+            {
+                'data': objects_list,
+                'meta': {'titles': display_fields},
+            },
+        )
+
+
+def server_sent_event(event, data):
+    return f'event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n'
+
+
+class StreamReport(ReportBuilderViewMixin, APIView):
+    """Stream preview rows as server-sent events: a meta event with the
+    titles, rows events of up to page_size rows and a done event with the
+    totals row, row count and elapsed seconds. Errors end the stream with
+    an error event.
+    """
+
+    def get(self, request, report_id=None):
+        report = get_object_or_404(Report, pk=report_id)
+        max_page_size = getattr(settings, 'REPORT_BUILDER_PREVIEW_MAX_PAGE_SIZE', 1000)
+        try:
+            page_size = int(request.query_params.get('page_size', 500))
+        except ValueError:
+            return Response({'detail': 'page_size must be a number.'}, status=status.HTTP_400_BAD_REQUEST)
+        page_size = min(max(page_size, 1), max_page_size)
+        response = StreamingHttpResponse(
+            self.stream(report, request.user, page_size),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Keep proxies such as nginx from buffering the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def stream(self, report, user, page_size):
+        started = time.monotonic()
+        titles = [display_field.name for display_field in report.get_good_display_fields()]
+        yield server_sent_event('meta', {'titles': titles})
+        pages = report.iter_preview_pages(page_size)
+        row_count = 0
+        try:
+            with report.track_run(ReportRun.STREAM, user, collect=False) as metrics:
+                while True:
+                    try:
+                        with metrics.collect(), report.limit_execution():
+                            rows = next(pages)
+                    except StopIteration as stop:
+                        totals = stop.value
+                        break
+                    row_count += len(rows)
+                    metrics.row_count = row_count
+                    yield server_sent_event('rows', rows)
+        except ReportTimeoutError as e:
+            yield server_sent_event('error', {'detail': str(e)})
+            return
+        except Exception:
+            # The response has started, the client can only learn of the error from an event
+            logger.exception('Report %s failed while streaming', report.pk)
+            yield server_sent_event('error', {'detail': 'The report failed.'})
+            return
+        done = {'totals': totals, 'rows': row_count, 'elapsed': round(time.monotonic() - started, 3)}
+        yield server_sent_event('done', done)
+
+
+class DiffReport(ReportBuilderViewMixin, APIView):
+    """Compare the stored run old with the stored run new, or with the
+    current data when new is not given, by the column titled key.
+    """
+
+    def get(self, request, report_id=None):
+        report = get_object_or_404(Report, pk=report_id)
+        runs = report.runs.filter(status=ReportRun.SUCCESS).exclude(report_file='')
+        try:
+            key = request.query_params['key']
+            old_run = runs.filter(pk=int(request.query_params['old'])).first()
+            new_run = None
+            if request.query_params.get('new'):
+                new_run = runs.filter(pk=int(request.query_params['new'])).first()
+        except (KeyError, ValueError):
+            return Response({'detail': 'key and old are required, runs are ids.'}, status=status.HTTP_400_BAD_REQUEST)
+        if old_run is None or (request.query_params.get('new') and new_run is None):
+            return Response({'detail': 'Run not found or without a file.'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            result = report.diff(key, old_run, new_run=new_run, user=request.user)
+        except ReportTimeoutError as e:
+            report.record_timeout(user=request.user)
+            return Response({'detail': str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+        except ValueError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(result)
+
+
+class ExplainReport(ReportBuilderViewMixin, APIView):
+    """Show the SQL and query plan of a report without running it.
+    Pass analyze=1 to run EXPLAIN ANALYZE within the statement timeout.
+    """
+
+    def get(self, request, report_id=None):
+        report = get_object_or_404(Report, pk=report_id)
+        analyze = request.query_params.get('analyze', '') in ('1', 'true', 'True')
+        try:
+            with report.limit_execution():
+                result = report.explain(analyze=analyze)
+        except ReportTimeoutError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_504_GATEWAY_TIMEOUT)
+        return Response(result)
@@ -0,0 +1,27 @@
+from django.apps import AppConfig, apps
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.test.signals import setting_changed
+
+
+class ReportBuilderConfig(AppConfig):
+    name = 'report_builder'
+    verbose_name = 'Report Builder'
+    default_auto_field = 'django.db.models.BigAutoField'
+
+    def ready(self):
+        from .registry import clear_registry, clear_registry_on_setting_changed
+        from .utils import clear_custom_fields_cache
+
+        # Migrations may add content types and change fields
+        post_migrate.connect(clear_registry, dispatch_uid='report_builder_clear_registry')
+        setting_changed.connect(clear_registry_on_setting_changed, dispatch_uid='report_builder_clear_registry')
+
+        if apps.is_installed('custom_field'):
+            from custom_field.models import CustomField
+
+            for signal in (post_save, post_delete):
+                signal.connect(
+                    clear_custom_fields_cache,
+                    sender=CustomField,
+                    dispatch_uid='report_builder_custom_fields',
+                )
@@ -1,41 +1,93 @@
+import smtplib
+
 from django.conf import settings
-from django.core.mail import EmailMultiAlternatives, send_mail
+from django.core.mail import EmailMultiAlternatives, get_connection, send_mail
+from django.template import TemplateDoesNotExist
 from django.template.loader import get_template
 
 
+def email_configured():
+    return bool(
+        (getattr(settings, 'EMAIL_BACKEND', False) or getattr(settings, 'EMAIL_HOST', False))
+        and getattr(settings, 'DEFAULT_FROM_EMAIL', False),
+    )
+
+
+def get_subject():
+    return getattr(settings, 'REPORT_BUILDER_EMAIL_SUBJECT', False) or 'Report is ready'
+
+
+def render_report_email(report_url, name=None):
+    """HTML body of the report email, None without the template"""
+    try:
+        email_template = get_template('email/email_report.html')
+    except TemplateDoesNotExist:
+        return None
+    return email_template.render({'name': name, 'report': report_url})
+
+
+def build_report_email(report_url, email, html=None, connection=None):
+    msg = EmailMultiAlternatives(
+        get_subject(),
+        str(report_url),
+        settings.DEFAULT_FROM_EMAIL,
+        [email],
+        connection=connection,
+    )
+    if html is not None:
+        msg.attach_alternative(html, "text/html")
+    return msg
+
+
 def email_report(report_url, user=None, email=None):
-    if (getattr(settings, 'EMAIL_BACKEND', False) or getattr(settings, 'EMAIL_HOST', False)) and getattr(
-        settings,
-        'DEFAULT_FROM_EMAIL',
-        False,
-    ):
+    if email_configured():
         name = None
         if user:
             email = user.email
             name = user.username
 
-        if get_template('email/email_report.html'):
-            email_template = get_template('email/email_report.html')
-            msg = EmailMultiAlternatives(
-                getattr(settings, 'REPORT_BUILDER_EMAIL_SUBJECT', False) or 'Report is ready',
-                report_url,
-                settings.DEFAULT_FROM_EMAIL,
-                [email],
-            )
-            html_parameters = {
-                'name': name,
-                'report': report_url,
-            }
-            msg.attach_alternative(
-                email_template.render(html_parameters),
-                "text/html",
-            )
-            msg.send()
+        html = render_report_email(report_url, name)
+        if html is not None:
+            build_report_email(report_url, email, html).send()
         else:
             send_mail(
-                getattr(settings, 'REPORT_BUILDER_EMAIL_SUBJECT', False) or 'Report is ready',
+                get_subject(),
                 str(report_url),
                 settings.DEFAULT_FROM_EMAIL,
                 [email],
                 fail_silently=True,
             )
+
+
+def email_reports(report_url, emails):
+    """Email report_url to each address over one connection, rendering the
+    template once. Returns the addresses that could not be sent to and are
+    worth retrying. Addresses the server refuses are dropped.
+    """
+    if not email_configured():
+        return []
+    html = render_report_email(report_url)
+    failed = []
+    connection = get_connection()
+    try:
+        connection.open()
+    except (smtplib.SMTPException, OSError):
+        return list(emails)
+    try:
+        for i, email in enumerate(emails):
+            try:
+                build_report_email(report_url, email, html, connection=connection).send()
+            except smtplib.SMTPRecipientsRefused:
+                # Retrying would be refused again
+                continue
+            except (smtplib.SMTPException, OSError):
+                failed.append(email)
+                # The connection may be broken, start over for the next address
+                connection.close()
+                try:
+                    connection.open()
+                except (smtplib.SMTPException, OSError):
+                    return failed + list(emails[i + 1 :])
+    finally:
+        connection.close()
+    return failed
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('report_builder', '0008_alter_displayfield_id_alter_filterfield_id_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fingerprint', models.CharField(blank=True, max_length=64)),
+                ('file_type', models.CharField(blank=True, max_length=4)),
+                ('report_file', models.FileField(blank=True, upload_to='report_files')),
+                ('row_count', models.PositiveIntegerField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('report', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='report_builder.report')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='report_run_set', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created', '-id'],
+                'indexes': [models.Index(fields=['report', 'fingerprint', 'created'], name='report_buil_report__eb70d7_idx')],
+            },
+        ),
+    ]
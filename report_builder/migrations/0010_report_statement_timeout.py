@@ -0,0 +1,23 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report_builder', '0009_reportrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='statement_timeout',
+            field=models.PositiveIntegerField(blank=True, help_text='Milliseconds a query of this report may run. Overrides REPORT_BUILDER_STATEMENT_TIMEOUT.', null=True),
+        ),
+        migrations.AddField(
+            model_name='reportrun',
+            name='status',
+            field=models.CharField(choices=[('success', 'Success'), ('timeout', 'Timed out')], default='success', max_length=10),
+        ),
+    ]
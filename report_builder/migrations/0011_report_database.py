@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report_builder', '0010_report_statement_timeout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='database',
+            field=models.CharField(blank=True, help_text="Database alias to run this report's queries on. Overrides REPORT_BUILDER_DATABASE.", max_length=100),
+        ),
+    ]
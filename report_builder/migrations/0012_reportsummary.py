@@ -0,0 +1,30 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:06
+
+import django.core.serializers.json
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report_builder', '0011_report_database'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('watermark_field', models.CharField(help_text='Root model field that only grows for new rows, e.g. id or created.', max_length=2000)),
+                ('watermark', models.JSONField(blank=True, editable=False, encoder=django.core.serializers.json.DjangoJSONEncoder, null=True)),
+                ('fingerprint', models.CharField(blank=True, editable=False, max_length=64)),
+                ('rows', models.JSONField(blank=True, default=dict, editable=False, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('refreshed', models.DateTimeField(blank=True, editable=False, null=True)),
+                ('report', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='summary', to='report_builder.report')),
+            ],
+            options={
+                'verbose_name_plural': 'report summaries',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 15:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report_builder', '0012_reportsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='report',
+            name='freshness_field',
+            field=models.CharField(blank=True, help_text='Root model field that changes whenever a row does, e.g. modified. Lets clients skip re-running the report while its results are unchanged.', max_length=2000),
+        ),
+    ]
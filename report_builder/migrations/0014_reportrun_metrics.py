@@ -0,0 +1,52 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report_builder', '0013_report_freshness_field'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reportrun',
+            name='byte_count',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportrun',
+            name='duration',
+            field=models.FloatField(blank=True, help_text='Seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='reportrun',
+            name='peak_memory',
+            field=models.PositiveBigIntegerField(blank=True, help_text='Bytes, with REPORT_BUILDER_TRACE_MEMORY', null=True),
+        ),
+        migrations.AddField(
+            model_name='reportrun',
+            name='query_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='reportrun',
+            name='timings',
+            field=models.JSONField(blank=True, default=dict, help_text='Seconds spent in each stage: query, properties, sort, format, encode and store'),
+        ),
+        migrations.AddField(
+            model_name='reportrun',
+            name='trigger',
+            field=models.CharField(blank=True, choices=[('preview', 'Preview'), ('stream', 'Stream'), ('download', 'Download'), ('async', 'Asynchronous download'), ('scheduled', 'Scheduled')], max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='reportrun',
+            name='status',
+            field=models.CharField(choices=[('success', 'Success'), ('timeout', 'Timed out'), ('error', 'Error'), ('cancelled', 'Cancelled')], default='success', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='reportrun',
+            index=models.Index(fields=['created'], name='report_buil_created_fea695_idx'),
+        ),
+    ]
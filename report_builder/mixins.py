@@ -1,27 +1,36 @@
 import csv
 import datetime
 import re
+import time
 from collections import namedtuple
 from decimal import Decimal
 from functools import reduce
 from io import BytesIO, StringIO
+from itertools import islice
 from numbers import Number
 from tempfile import NamedTemporaryFile
 
 from django.contrib.contenttypes.models import ContentType
-from django.db.models import Avg, Count, Max, Min, Sum
+from django.db.models import Avg, Count, Max, Min, Sum, prefetch_related_objects
 from django.db.models.fields.related_descriptors import ManyToManyDescriptor
 from django.http import HttpResponse
 from openpyxl.styles import Font
 from openpyxl.utils import get_column_letter
 from openpyxl.workbook import Workbook
 
+from .registry import get_model_info
 from .utils import (
+    format_row,
+    formatter,
     get_custom_fields_from_model,
-    get_direct_fields_from_model,
+    get_generic_foreign_keys,
     get_model_from_path_string,
-    get_properties_from_model,
+    get_models_from_path_strings,
     get_relation_fields_from_model,
+    get_row_formats,
+    get_run_metrics,
+    load_custom_values,
+    run_stage,
 )
 
 
@@ -182,13 +191,49 @@ class DataExportMixin:
 
         return queryset
 
-    def report_to_list(self, queryset, display_fields, user=None, property_filters=None, preview=False):
+    def iter_row_blocks(self, values_list, model_class, custom_list, load_objects=False, block_size=1000):
+        """Yield rows of a values_list that starts with the pk, in blocks.
+        Each row comes with the custom field values of its block, keyed by
+        (pk, field name), and, if load_objects, the block's objects by pk with
+        their generic relations prefetched, one query per content type.
+        """
+        rows = iter(values_list)
+        while True:
+            block = list(islice(rows, block_size))
+            if not block:
+                return
+            pks = list(dict.fromkeys(row[0] for row in block))
+            custom_values = {}
+            if custom_list:
+                custom_values = load_custom_values(
+                    model_class,
+                    set(custom_list.values()),
+                    pks,
+                    using=values_list.db,
+                )
+            objects = {}
+            if load_objects:
+                objects = model_class.objects.using(values_list.db).in_bulk(pks)
+                prefetch_related_objects(list(objects.values()), *get_generic_foreign_keys(model_class))
+            for row in block:
+                yield row, custom_values, objects
+
+    def report_to_list(
+        self,
+        queryset,
+        display_fields,
+        user=None,
+        property_filters=None,
+        preview=False,
+        grouped_rows=None,
+    ):
         """Create list from a report with all data filtering.
         queryset: initial queryset to generate results
         display_fields: list of field references or DisplayField models
         user: requesting user. If left as None - there will be no permission check
         property_filters: ???
         preview: return only first 50 rows
+        grouped_rows: precomputed group-by rows to use instead of querying
         Returns list, message in case of issues.
         """
         if property_filters is None:
@@ -211,7 +256,7 @@ class DataExportMixin:
         if not can_change_or_view(model_class):
             return [], 'Permission Denied'
 
-        if isinstance(display_fields, list):
+        if isinstance(display_fields, list) and all(isinstance(df, str) for df in display_fields):
             # Convert list of strings to DisplayField objects.
 
             new_display_fields = []
@@ -265,8 +310,9 @@ class DataExportMixin:
         custom_list = {}
         display_totals = {}
 
+        models_by_path = get_models_from_path_strings(model_class, [df.path for df in display_fields])
         for i, display_field in enumerate(display_fields):
-            model = get_model_from_path_string(model_class, display_field.path)
+            model = models_by_path[display_field.path]
 
             if display_field.field_type == "Invalid":
                 continue
@@ -332,9 +378,14 @@ class DataExportMixin:
                     display_field_paths.insert(1, f'{property_root}__pk')
                     m2m_relations.append(property_root)
 
+        metrics = get_run_metrics()
+        query_started = time.perf_counter()
         if group:
-            values = objects.values(*group)
-            values = self.add_aggregates(values, display_fields)
+            if grouped_rows is not None:
+                values = grouped_rows
+            else:
+                values = objects.values(*group)
+                values = self.add_aggregates(values, display_fields)
             filtered_report_rows = [[row[field] for field in display_field_paths] for row in values]
             for row in filtered_report_rows:
                 for pos, field in enumerate(display_field_paths):
@@ -345,7 +396,17 @@ class DataExportMixin:
 
             values_list = objects.values_list(*display_field_paths)
 
-            for row in values_list:
+            load_objects = bool(property_filters or property_list)
+            property_seconds = 0
+            row_blocks = self.iter_row_blocks(
+                values_list,
+                model_class,
+                custom_list,
+                load_objects=load_objects,
+            )
+            for row, custom_values, block_objects in row_blocks:
+                property_started = time.perf_counter()
+                pk = row[0]
                 row = list(row)
                 values_and_properties_list.append(row[1:])
                 obj = None  # we will get this only if needed for more complex processing
@@ -354,7 +415,7 @@ class DataExportMixin:
                 # filter properties (remove rows with excluded properties)
                 for property_filter in property_filters:
                     if not obj:
-                        obj = model_class.objects.get(pk=row.pop(0))
+                        obj = block_objects[row.pop(0)]
                     root_relation = property_filter.path.split('__')[0]
                     if root_relation in m2m_relations:
                         pk = row[0]
@@ -382,7 +443,7 @@ class DataExportMixin:
 
                     for position, display_property in property_list.items():
                         if not obj:
-                            obj = model_class.objects.get(pk=row.pop(0))
+                            obj = block_objects[row.pop(0)]
                         relations = display_property.split('__')
                         root_relation = relations[0]
                         if root_relation in m2m_relations:
@@ -403,20 +464,28 @@ class DataExportMixin:
                         increment_total(display_property, val)
 
                     for position, display_custom in custom_list.items():
-                        if not obj:
-                            obj = model_class.objects.get(pk=row.pop(0))
-                        val = obj.get_custom_value(display_custom)
+                        val = custom_values.get((pk, display_custom))
                         values_and_properties_list[-1].insert(position, val)
                         increment_total(display_custom, val)
 
                     filtered_report_rows.append(values_and_properties_list[-1])
 
+                if load_objects:
+                    property_seconds += time.perf_counter() - property_started
                 if preview and len(filtered_report_rows) == 50:
                     break
 
+            if metrics:
+                metrics.add('properties', property_seconds)
+                query_started += property_seconds
+        if metrics:
+            metrics.add('query', time.perf_counter() - query_started)
+
         # Sort results if requested.
 
-        if hasattr(display_fields, 'filter'):
+        # Field names given as strings have no sort options
+        sort_fields = [df for df in display_fields if getattr(df, 'sort', None) and df.sort > 0]
+        if sort_fields:
             defaults = {
                 None: str,
                 datetime.date: lambda: datetime.date(datetime.MINYEAR, 1, 1),
@@ -427,73 +496,37 @@ class DataExportMixin:
             # sort orders work together (based on Python's stable sort). See
             # http://stackoverflow.com/questions/6666748/ for details.
 
-            sort_fields = display_fields.filter(sort__gt=0).order_by('-sort')
-            sort_values = sort_fields.values_list('position', 'sort_reverse')
+            sort_fields = sorted(sort_fields, key=lambda df: df.sort, reverse=True)
+            sort_values = [(df.position, df.sort_reverse) for df in sort_fields]
 
-            for pos, reverse in sort_values:
-                column = (row[pos] for row in filtered_report_rows)
-                type_col = (type(val) for val in column if val is not None)
-                field_type = next(type_col, None)
-                default = defaults.get(field_type, field_type)()
+            with run_stage('sort'):
+                for pos, reverse in sort_values:
+                    column = (row[pos] for row in filtered_report_rows)
+                    type_col = (type(val) for val in column if val is not None)
+                    field_type = next(type_col, None)
+                    default = defaults.get(field_type, field_type)()
 
-                filtered_report_rows = sorted(
-                    filtered_report_rows,
-                    key=lambda row: self.sort_helper(row[pos], default),
-                    reverse=reverse,
-                )
+                    filtered_report_rows = sorted(
+                        filtered_report_rows,
+                        key=lambda row: self.sort_helper(row[pos], default),
+                        reverse=reverse,
+                    )
 
         values_and_properties_list = filtered_report_rows
 
-        # Build mapping from display field position to choices list.
-
-        choice_lists = {}
-        for df in display_fields:
-            if df.choices and hasattr(df, 'choices_dict'):
-                df_choices = df.choices_dict
-                # Insert blank and None as valid choices.
-                df_choices[''] = ''
-                df_choices[None] = ''
-                choice_lists[df.position] = df_choices
-
-        # Build mapping from display field position to format.
-
-        display_formats = {}
-
-        for df in display_fields:
-            if hasattr(df, 'display_format') and df.display_format:
-                display_formats[df.position] = df.display_format
-
-        def formatter(value, style):
-            # Convert value to Decimal to apply numeric formats.
-            try:
-                value = Decimal(value)
-            except Exception:
-                pass
-
-            try:
-                return style.string.format(value)
-            except ValueError:
-                return value
+        choice_lists, display_formats = get_row_formats(display_fields)
 
         # Iterate rows and convert values by choice lists and field formats.
 
         final_list = []
 
-        for row in values_and_properties_list:
-            row = list(row)
-
-            for position, choice_list in choice_lists.items():
-                try:
-                    row[position] = str(choice_list[row[position]])
-                except Exception:
-                    row[position] = str(row[position])
-
-            for pos, style in display_formats.items():
-                row[pos] = formatter(row[pos], style)
-
-            final_list.append(row)
+        with run_stage('format'):
+            for row in values_and_properties_list:
+                final_list.append(format_row(list(row), choice_lists, display_formats))
 
         values_and_properties_list = final_list
+        if metrics:
+            metrics.row_count = len(final_list)
 
         if display_totals:
             display_totals_row = []
@@ -542,8 +575,7 @@ class GetFieldsMixin:
             path_verbose: Our new human readable path
         :rtype: dict
         """
-        fields = get_direct_fields_from_model(model_class)
-        properties = get_properties_from_model(model_class)
+        info = get_model_info(model_class)
         custom_fields = get_custom_fields_from_model(model_class)
         app_label = model_class._meta.app_label
         model = model_class
@@ -569,51 +601,44 @@ class GetFieldsMixin:
                 new_model = field.related_model
                 path_verbose = new_model.__name__.lower()
 
-            fields = get_direct_fields_from_model(new_model)
-
+            info = get_model_info(new_model)
             custom_fields = get_custom_fields_from_model(new_model)
-            properties = get_properties_from_model(new_model)
             app_label = new_model._meta.app_label
             model = new_model
 
         return {
-            'fields': fields,
+            'fields': list(info.direct_fields),
             'custom_fields': custom_fields,
-            'properties': properties,
+            'properties': list(info.properties),
             'path': path,
             'path_verbose': path_verbose,
             'app_label': app_label,
             'model': model,
         }
 
-    def get_related_fields(self, model_class, field_name, path="", path_verbose=""):
-        """Get fields for a given model"""
-        if field_name:
-            field = model_class._meta.get_field(field_name)
-            direct = field.concrete
-            if direct:
-                try:
-                    related_field = field.remote_field
-                except AttributeError:
-                    # Needed for Django < 1.9
-                    related_field = field.related
-                try:
-                    new_model = related_field.parent_model()
-                except AttributeError:
-                    new_model = related_field.model
-            else:
-                # Indirect related field
-                new_model = field.related_model
-
-            if path_verbose:
-                path_verbose += "::"
-            path_verbose += field.name
-
-            path += field_name
-            path += '__'
+    def get_related_model(self, model_class, field_name, path=""):
+        """Return the model a field relates to and the path to it"""
+        if not field_name:
+            return model_class, path
+        field = model_class._meta.get_field(field_name)
+        if field.concrete:
+            try:
+                related_field = field.remote_field
+            except AttributeError:
+                # Needed for Django < 1.9
+                related_field = field.related
+            try:
+                new_model = related_field.parent_model()
+            except AttributeError:
+                new_model = related_field.model
         else:
-            new_model = model_class
+            # Indirect related field
+            new_model = field.related_model
+        return new_model, path + field_name + '__'
 
+    def get_related_fields(self, model_class, field_name, path="", path_verbose=""):
+        """Get fields for a given model"""
+        new_model, path = self.get_related_model(model_class, field_name, path)
         new_fields = get_relation_fields_from_model(new_model)
         model_ct = ContentType.objects.get_for_model(new_model)
 
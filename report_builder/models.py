@@ -1,7 +1,12 @@
+import base64
 import datetime
+import hashlib
+import json
+import os
 import re
 import time
 import zipfile
+from contextlib import contextmanager, nullcontext
 from decimal import Decimal
 from functools import reduce
 from io import BytesIO
@@ -12,10 +17,13 @@ from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist, ValidationError
 from django.core.files.base import ContentFile
-from django.db import models
-from django.db.models import Avg, Count, F, Max, Min, Sum
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, models, router, transaction
+from django.db.models import Avg, Count, Exists, F, Max, Min, OuterRef, Q, Sum
+from django.http import FileResponse
 from django.templatetags.static import static
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.safestring import mark_safe
 
@@ -23,36 +31,36 @@ from report_builder.unique_slugify import unique_slugify
 
 from .email import email_report
 from .mixins import DataExportMixin, generate_filename
-from .utils import formatter, get_model_from_path_string, increment_total, sort_data
+from .registry import get_allowed_model_keys
+from .utils import (
+    ReportTimeoutError,
+    RunMetrics,
+    diff_rows,
+    duplicate,
+    explain_queryset,
+    format_row,
+    formatter,
+    get_custom_field_values,
+    get_generic_foreign_keys,
+    get_model_from_path_string,
+    get_row_formats,
+    get_run_metrics,
+    increment_total,
+    iter_file_rows,
+    percentile,
+    run_stage,
+    sort_data,
+    statement_timeout,
+)
 
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
 
 def get_allowed_models():
-    models = ContentType.objects.all()
-    if getattr(settings, 'REPORT_BUILDER_INCLUDE', False):
-        all_model_names = []
-        additional_models = []
-        for element in settings.REPORT_BUILDER_INCLUDE:
-            split_element = element.split('.')
-            if len(split_element) == 2:
-                additional_models.append(models.filter(app_label=split_element[0], model=split_element[1]))
-            else:
-                all_model_names.append(element)
-        models = models.filter(model__in=all_model_names)
-        for additional_model in additional_models:
-            models = models | additional_model
-    if getattr(settings, 'REPORT_BUILDER_EXCLUDE', False):
-        all_model_names = []
-        for element in settings.REPORT_BUILDER_EXCLUDE:
-            split_element = element.split('.')
-            if len(split_element) == 2:
-                models = models.exclude(app_label=split_element[0], model=split_element[1])
-            else:
-                all_model_names.append(element)
-        models = models.exclude(model__in=all_model_names)
-    return models
+    """Content types reports may use, see REPORT_BUILDER_INCLUDE/EXCLUDE"""
+    keys, pks = get_allowed_model_keys()
+    return ContentType.objects.filter(pk__in=sorted(pks))
 
 
 def get_limit_choices_to_callable():
@@ -86,6 +94,22 @@ class Report(models.Model):
         help_text="These users have starred this report for easy reference.",
         related_name="report_starred_set",
     )
+    statement_timeout = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text="Milliseconds a query of this report may run. Overrides REPORT_BUILDER_STATEMENT_TIMEOUT.",
+    )
+    database = models.CharField(
+        max_length=100,
+        blank=True,
+        help_text="Database alias to run this report's queries on. Overrides REPORT_BUILDER_DATABASE.",
+    )
+    freshness_field = models.CharField(
+        max_length=2000,
+        blank=True,
+        help_text="Root model field that changes whenever a row does, e.g. modified. "
+        "Lets clients skip re-running the report while its results are unchanged.",
+    )
 
     def __str__(self):
         return self.name
@@ -98,6 +122,16 @@ class Report(models.Model):
     def get_absolute_url(self):
         return reverse("report_update_view", args=(self.id,))
 
+    def clean(self):
+        if self.database and self.database not in connections.databases:
+            raise ValidationError({'database': f'Unknown database alias "{self.database}".'})
+        if self.freshness_field:
+            try:
+                self.root_model_class._meta.get_field(self.freshness_field)
+            except FieldDoesNotExist:
+                raise ValidationError({'freshness_field': 'Not a field of the root model.'}) from None
+        return super().clean()
+
     def _get_model_manager(self):
         """Get manager from settings else use objects"""
         model_manager = 'objects'
@@ -109,6 +143,129 @@ class Report(models.Model):
     def allowed_models():
         return get_allowed_models()
 
+    @staticmethod
+    def starred_by(user):
+        """Expression for annotate: whether user starred the report"""
+        return Exists(Report.starred.through.objects.filter(report=OuterRef('pk'), user=user.pk))
+
+    def clone(self, **changes):
+        """Copy the report with its display fields, filter fields and stars.
+        changes are set on the copy, e.g. name='Copy'. Uses a fixed number
+        of queries however many fields the report has.
+        """
+        with transaction.atomic():
+            new_report = duplicate(self, changes=changes.items())
+            for model in (DisplayField, FilterField):
+                fields = list(model.objects.filter(report=self))
+                for field in fields:
+                    field.pk = None
+                    field.report = new_report
+                model.objects.bulk_create(fields)
+        return new_report
+
+    def get_statement_timeout(self):
+        """Timeout in milliseconds, from this report else from settings"""
+        if self.statement_timeout:
+            return self.statement_timeout
+        return getattr(settings, 'REPORT_BUILDER_STATEMENT_TIMEOUT', None)
+
+    def get_database(self):
+        """Database alias for report queries, from this report else from settings.
+        None leaves the choice to the database routers.
+        """
+        return self.database or getattr(settings, 'REPORT_BUILDER_DATABASE', None)
+
+    def limit_execution(self):
+        """Context manager applying the statement timeout to report queries"""
+        using = self.get_database() or router.db_for_read(self.root_model_class)
+        return statement_timeout(self.get_statement_timeout(), using=using)
+
+    def get_to_many_paths(self):
+        """Relation paths of display and filter fields that join to-many
+        relations. Each such join repeats the root rows it matches.
+        """
+        paths = set()
+        fields = self.get_display_fields() + self.get_filter_fields()
+        for field in fields:
+            model = self.root_model_class
+            path = ''
+            for section in field.path.split('__'):
+                if not section:
+                    continue
+                path += section + '__'
+                try:
+                    relation = model._meta.get_field(section)
+                except FieldDoesNotExist:
+                    break
+                if relation.one_to_many or relation.many_to_many:
+                    paths.add(path)
+                model = relation.related_model
+                if model is None:
+                    break
+        return sorted(paths)
+
+    def explain(self, analyze=False):
+        """SQL, query plan and plan warnings of this report's query"""
+        result = explain_queryset(self.get_query(), analyze=analyze)
+        for path in self.get_to_many_paths():
+            result['warnings'].append(
+                f'Joining {path[:-2]} repeats root rows for every related row. '
+                'Consider grouping, distinct or a filter on it.',
+            )
+        return result
+
+    @contextmanager
+    def track_run(self, trigger, user=None, file_type='', fingerprint='', collect=True, trace_memory=True):
+        """Record a ReportRun with the outcome, timings and sizes of the block.
+        The block gets the RunMetrics and can set metrics.run to a run it
+        stored, which is completed instead. Without collect the block measures
+        its parts with metrics.collect, e.g. to leave out the time a stream
+        waits on its client. trace_memory=False skips memory tracing, which
+        covers the whole process. Unsaved reports are not recorded.
+        """
+        metrics = RunMetrics(
+            self.get_database() or router.db_for_read(self.root_model_class),
+            trace_memory=trace_memory,
+        )
+        if self.pk is None:
+            yield metrics
+            return
+        status = ReportRun.ERROR
+        try:
+            with metrics.collect() if collect else nullcontext():
+                yield metrics
+            status = ReportRun.SUCCESS
+        except ReportTimeoutError:
+            status = ReportRun.TIMEOUT
+            raise
+        except GeneratorExit:
+            # A streaming client went away
+            status = ReportRun.CANCELLED
+            raise
+        finally:
+            run = metrics.run or ReportRun(report=self, user=user, file_type=file_type, fingerprint=fingerprint)
+            run.status = status
+            run.trigger = trigger
+            run.duration = metrics.duration
+            run.timings = {stage: round(seconds, 6) for stage, seconds in metrics.timings.items()}
+            if metrics.row_count is not None:
+                run.row_count = metrics.row_count
+            run.byte_count = metrics.byte_count
+            run.query_count = metrics.query_count
+            run.peak_memory = metrics.peak_memory
+            # Saving in a broken transaction would hide the original error
+            if not transaction.get_connection(router.db_for_write(ReportRun)).needs_rollback:
+                run.save()
+
+    def record_timeout(self, user=None, file_type='', fingerprint=''):
+        return ReportRun.objects.create(
+            report=self,
+            user=user,
+            file_type=file_type,
+            fingerprint=fingerprint,
+            status=ReportRun.TIMEOUT,
+        )
+
     def add_aggregates(self, queryset, display_fields=None):
         agg_funcs = {
             'Avg': Avg,
@@ -118,7 +275,7 @@ class Report(models.Model):
             'Sum': Sum,
         }
         if display_fields is None:
-            display_fields = self.displayfield_set.filter(aggregate__isnull=False)
+            display_fields = self.get_display_fields()
         for display_field in display_fields:
             if display_field.aggregate:
                 func = agg_funcs[display_field.aggregate]
@@ -155,21 +312,36 @@ class Report(models.Model):
             pass
         return "Invalid"
 
+    def use_fields(self, display_fields, filter_fields):
+        """Run with these display and filter fields instead of the saved ones,
+        e.g. to preview a definition that was never saved.
+        """
+        self._unsaved_fields = (list(display_fields), list(filter_fields))
+
+    def get_display_fields(self):
+        """Display fields in position order"""
+        if getattr(self, '_unsaved_fields', None) is not None:
+            return list(self._unsaved_fields[0])
+        return list(self.displayfield_set.all())
+
+    def get_filter_fields(self):
+        """Filter fields in position order"""
+        if getattr(self, '_unsaved_fields', None) is not None:
+            return list(self._unsaved_fields[1])
+        return list(self.filterfield_set.all())
+
     def get_good_display_fields(self):
         """Returns only valid display fields"""
-        display_fields = self.displayfield_set.all()
-        bad_display_fields = []
-        for display_field in display_fields:
-            if display_field.field_type == "Invalid":
-                bad_display_fields.append(display_field)
-        return display_fields.exclude(id__in=[o.id for o in bad_display_fields])
+        return [display_field for display_field in self.get_display_fields() if display_field.field_type != "Invalid"]
 
     def report_to_list(self, queryset=None, user=None, preview=False):
         """Convert report into list."""
         property_filters = []
+        # A summary only holds rows of the report's own query
+        use_summary = queryset is None
         if queryset is None:
             queryset = self.get_query()
-            for field in self.filterfield_set.all():
+            for field in self.get_filter_fields():
                 if field.field_type in ["Property"]:
                     property_filters += [field]
         display_fields = self.get_good_display_fields()
@@ -179,8 +351,6 @@ class Report(models.Model):
         display_field_properties = []
         display_totals = []
         insert_property_indexes = []
-        choice_lists = {}
-        display_formats = {}
         i = 0
         for display_field in display_fields:
             if display_field.total:
@@ -196,35 +366,30 @@ class Report(models.Model):
                 else:
                     display_field_paths += [display_field.field_key]
             i += 1
-
-            # Build display choices list
-            if display_field.choices and hasattr(display_field, 'choices_dict'):
-                choice_list = display_field.choices_dict
-                # Insert blank and None as valid choices.
-                choice_list[''] = ''
-                choice_list[None] = ''
-                choice_lists[display_field.position] = choice_list
-
-            # Build display format list
-            if hasattr(display_field, 'display_format') and display_field.display_format:
-                display_formats[display_field.position] = display_field.display_format
+        choice_lists, display_formats = get_row_formats(display_fields)
 
         property_filters = []
-        for filter_field in self.filterfield_set.all():
+        for filter_field in self.get_filter_fields():
             filter_field_type = filter_field.field_type
             if filter_field_type == "Property":
                 property_filters += [field]
 
         group = [df.path + df.field for df in display_fields if df.group]
 
+        # Properties and formats are applied while reading, all of it counts as query time
+        metrics = get_run_metrics()
+        query_started = time.perf_counter()
+
         # To support group-by with multiple fields, we turn all the other
         # fields into aggregations. The default aggregation is `Max`.
         if group:
             for field in display_fields:
                 if (not field.group) and (not field.aggregate):
                     field.aggregate = 'Max'
-            values = queryset.values(*group)
-            values = self.add_aggregates(values, display_fields)
+            values = self.get_summary_rows(display_fields) if use_summary else None
+            if values is None:
+                values = queryset.values(*group)
+                values = self.add_aggregates(values, display_fields)
             data_list = []
             for row in values:
                 row_data = []
@@ -239,11 +404,18 @@ class Report(models.Model):
                     increment_total(total, row_data)
                 data_list.append(row_data)
         else:
+            if not queryset.ordered:
+                # Rows are matched to objects by position, both queries need the same order
+                queryset = queryset.order_by('pk')
             values_list = list(queryset.values_list(*display_field_paths))
 
             data_list = []
             values_index = 0
-            for obj in queryset:
+            objects = queryset
+            if display_field_properties or property_filters:
+                # Properties may read generic relations, load their targets per content type
+                objects = queryset.prefetch_related(*get_generic_foreign_keys(queryset.model))
+            for obj in objects:
                 display_property_values = []
                 for display_property in display_field_properties:
                     relations = display_property.split('__')
@@ -266,45 +438,174 @@ class Report(models.Model):
                     if add_row is True:
                         for total in display_totals:
                             increment_total(total, data_row)
-                        # Replace choice data with display choice string
-                        for position, choice_list in choice_lists.items():
-                            try:
-                                data_row[position] = str(choice_list[data_row[position]])
-                            except Exception:
-                                data_row[position] = str(data_row[position])
-                        for position, style in display_formats.items():
-                            data_row[position] = formatter(data_row[position], style)
-                        data_list.append(data_row)
+                        data_list.append(format_row(data_row, choice_lists, display_formats))
                     values_index += 1
                     try:
                         value_row = values_list[values_index]
                     except IndexError:
                         break
 
-        for display_field in display_fields.filter(
-            sort__gt=0,
-        ).order_by('-sort'):
-            data_list = sort_data(data_list, display_field)
+        if metrics:
+            metrics.add('query', time.perf_counter() - query_started)
+            metrics.row_count = len(data_list)
 
-        if display_totals:
-            display_totals_row = []
-            i = 0
-            for display_field in display_totals:
-                while i < display_field.position:
-                    i += 1
-                    display_totals_row.append('')
-                i += 1
-                display_totals_row.append(display_field.total_count)
-            # Add formats to display totals
-            for pos, style in display_formats.items():
-                display_totals_row[pos] = formatter(display_totals_row[pos], style)
+        sort_fields = [df for df in display_fields if df.sort and df.sort > 0]
+        with run_stage('sort'):
+            for display_field in sorted(sort_fields, key=lambda df: df.sort, reverse=True):
+                data_list = sort_data(data_list, display_field)
 
+        if display_totals:
             data_list += [
                 ['TOTALS'] + (len(display_fields) - 1) * [''],
-            ] + [display_totals_row]
+            ] + [self.get_totals_row(display_totals, display_formats)]
 
         return data_list
 
+    @staticmethod
+    def get_totals_row(display_totals, display_formats):
+        """Row of the total_count of display_totals, placed by position"""
+        display_totals_row = []
+        i = 0
+        for display_field in display_totals:
+            while i < display_field.position:
+                i += 1
+                display_totals_row.append('')
+            i += 1
+            display_totals_row.append(display_field.total_count)
+        # Add formats to display totals
+        for pos, style in display_formats.items():
+            display_totals_row[pos] = formatter(display_totals_row[pos], style)
+        return display_totals_row
+
+    def supports_keyset_pagination(self, display_fields=None):
+        """Whether rows can be paged in the database: plain ORM columns only,
+        no grouping or aggregates and no to-many joins repeating a pk.
+        """
+        if display_fields is None:
+            display_fields = self.get_good_display_fields()
+        for display_field in display_fields:
+            if display_field.group or display_field.aggregate:
+                return False
+            if display_field.field_type in ('Property', 'Custom Field'):
+                return False
+        for filter_field in self.get_filter_fields():
+            if filter_field.field_type in ('Property', 'Custom Field'):
+                return False
+        return not self.get_to_many_paths()
+
+    @staticmethod
+    def encode_cursor(values):
+        return base64.urlsafe_b64encode(json.dumps(values, cls=DjangoJSONEncoder).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise ValueError('Invalid cursor.') from None
+        if not isinstance(values, list):
+            raise ValueError('Invalid cursor.')
+        return values
+
+    def get_keyset_page(self, cursor=None, page_size=50, display_totals=()):
+        """Return one page of preview rows after cursor and the cursor of
+        the next page, None on the last page.
+        Rows are ordered by the sort columns then pk and are read with a
+        keyset condition, so every page costs the same. Ascending columns
+        put nulls first and descending columns put them last.
+        The total_count of display_totals is incremented with the page's
+        values. Raises ValueError when the report can not be paged this way
+        or the cursor is invalid.
+        """
+        display_fields = list(self.get_good_display_fields())
+        if not self.supports_keyset_pagination(display_fields):
+            raise ValueError('This report can not be paginated.')
+
+        sort_fields = sorted((df for df in display_fields if df.sort and df.sort > 0), key=lambda df: df.sort)
+        keys = [(df.field_key, df.sort_reverse) for df in sort_fields] + [('pk', False)]
+        ordering = [F(key).desc(nulls_last=True) if reverse else F(key).asc(nulls_first=True) for key, reverse in keys]
+        queryset = self.get_query().order_by(*ordering)
+
+        if cursor:
+            values = self.decode_cursor(cursor)
+            if len(values) != len(keys):
+                raise ValueError('Invalid cursor.')
+            after = Q(pk__in=[])
+            equal = Q()
+            for (key, reverse), value in zip(keys, values, strict=True):
+                if value is None:
+                    key_after = Q(pk__in=[]) if reverse else Q(**{key + '__isnull': False})
+                    key_equal = Q(**{key + '__isnull': True})
+                else:
+                    key_after = Q(**{key + ('__lt' if reverse else '__gt'): value})
+                    if reverse:
+                        key_after |= Q(**{key + '__isnull': True})
+                    key_equal = Q(**{key: value})
+                after |= equal & key_after
+                equal &= key_equal
+            queryset = queryset.filter(after)
+
+        columns = [df.field_key for df in display_fields]
+        rows = list(queryset.values_list(*columns, *[key for key, reverse in keys])[: page_size + 1])
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = self.encode_cursor(list(rows[-1][len(columns) :]))
+
+        choice_lists, display_formats = get_row_formats(display_fields)
+        data_list = []
+        for row in rows:
+            data_row = list(row[: len(columns)])
+            for total in display_totals:
+                increment_total(total, data_row)
+            data_list.append(format_row(data_row, choice_lists, display_formats))
+        return data_list, next_cursor
+
+    def iter_preview_pages(self, page_size=500):
+        """Yield preview rows a page at a time, then return the totals row
+        or None when no column is totalled.
+        Reports that can be paged in the database are read one page at a
+        time, so the first rows come before the rest are read and closing
+        the generator stops reading. Others are computed with report_to_list
+        and then split into pages.
+        """
+        display_fields = self.get_good_display_fields()
+        display_totals = [df for df in display_fields if df.total]
+        if not self.supports_keyset_pagination(display_fields):
+            data_list = self.report_to_list(preview=True)
+            totals_row = None
+            if display_totals and data_list:
+                # Drop the TOTALS label row and the totals row
+                totals_row = data_list[-1]
+                data_list = data_list[:-2]
+            for start in range(0, len(data_list), page_size):
+                yield data_list[start : start + page_size]
+            return totals_row
+
+        for display_field in display_totals:
+            display_field.total_count = Decimal(0)
+        cursor = None
+        while True:
+            rows, cursor = self.get_keyset_page(cursor, page_size, display_totals=display_totals)
+            if rows:
+                yield rows
+            if not cursor:
+                break
+        if not display_totals:
+            return None
+        display_formats = {df.position: df.display_format for df in display_fields if df.display_format}
+        return self.get_totals_row(display_totals, display_formats)
+
+    def get_summary_rows(self, display_fields):
+        """Group-by rows from this report's summary, or None when it has none
+        or the summary can not represent the current definition.
+        """
+        try:
+            summary = self.summary
+        except ReportSummary.DoesNotExist:
+            return None
+        return summary.get_rows(display_fields)
+
     def get_query(self):
         report = self
         model_class = self.root_model_class
@@ -317,22 +618,28 @@ class Report(models.Model):
             manager = report._get_model_manager()
             objects = getattr(model_class, manager).all()
 
+        if report.get_database():
+            objects = objects.using(report.get_database())
+
         # Filters
         # NOTE: group all the filters together into one in order to avoid
         # unnecessary joins
         filters = {}
         excludes = {}
-        for filter_field in report.filterfield_set.order_by('position'):
+        custom_filters = []
+        for filter_field in report.get_filter_fields():
             # exclude properties from standard ORM filtering
             if filter_field.field_type == "Property":
                 continue
-            if filter_field.field_type == "Custom Field":
-                continue
             if filter_field.filter_type in ('max', 'min'):
                 # Annotation-filters are handled below.
                 continue
 
-            filter_string = str(filter_field.path + filter_field.field)
+            if filter_field.field_type == "Custom Field":
+                # Filters on the stored value, matched by object id below
+                filter_string = 'value'
+            else:
+                filter_string = str(filter_field.path + filter_field.field)
 
             if filter_field.filter_type:
                 ft = filter_field.filter_type
@@ -353,7 +660,9 @@ class Report(models.Model):
                     filter_value = filter_field.get_relative_range()
                 filter_ = {filter_string: filter_value}
 
-            if not filter_field.exclude:
+            if filter_field.field_type == "Custom Field":
+                custom_filters.append((filter_field, filter_))
+            elif not filter_field.exclude:
                 filters.update(filter_)
             else:
                 excludes.update(filter_)
@@ -363,8 +672,16 @@ class Report(models.Model):
         if excludes:
             objects = objects.exclude(**excludes)
 
+        # Custom field values live in another table, filter on a subquery of their object ids
+        for filter_field, filter_ in custom_filters:
+            custom_model = get_model_from_path_string(model_class, filter_field.path)
+            matching = get_custom_field_values(custom_model, [filter_field.field], using=objects.db)
+            matching = matching.filter(**filter_).values('object_id')
+            lookup = {filter_field.path + 'pk__in': matching}
+            objects = objects.exclude(**lookup) if filter_field.exclude else objects.filter(**lookup)
+
         # Apply annotation-filters after regular filters.
-        for filter_field in report.filterfield_set.order_by('position'):
+        for filter_field in report.get_filter_fields():
             if filter_field.filter_type in ('max', 'min'):
                 func = {'max': Max, 'min': Min}[filter_field.filter_type]
                 column_name = f'{filter_field.path}{filter_field.field}__{filter_field.field_type}'
@@ -429,8 +746,76 @@ class Report(models.Model):
         report_url = self.report_file.url
         return email_report(report_url, user=user, email=email)
 
-    def async_report_save(self, chunks, title, header, widths, user=None, file_type=None, email_to: str = None):
-        data_export = DataExportMixin()
+    def get_fingerprint(self, file_type, user=None):
+        """Hash of everything that shapes a generated file for this report.
+        Runs with the same fingerprint produce the same file for unchanged data.
+        """
+        definition = {
+            'root_model': self.root_model_id,
+            'distinct': self.distinct,
+            'file_type': file_type,
+            # Permission checks depend on the requesting user
+            'user': user.pk if user else None,
+            'display_fields': list(
+                self.displayfield_set.values_list(
+                    'path',
+                    'field',
+                    'name',
+                    'sort',
+                    'sort_reverse',
+                    'width',
+                    'aggregate',
+                    'position',
+                    'total',
+                    'group',
+                    'display_format__string',
+                ),
+            ),
+            'filter_fields': list(
+                self.filterfield_set.values_list(
+                    'path',
+                    'field',
+                    'filter_type',
+                    'filter_value',
+                    'filter_value2',
+                    'filter_delta',
+                    'exclude',
+                    'position',
+                ),
+            ),
+        }
+        return hashlib.sha256(json.dumps(definition, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get_freshness(self, file_type, user=None):
+        """ETag of the current results, None without a freshness field. It
+        comes from the definition, the latest freshness value and the count of
+        matching rows, which is much cheaper than running the report. Changes
+        to related rows are not seen. There is no Last-Modified: deleting the
+        newest row would not move it back, so only the ETag is validated.
+        """
+        if not self.freshness_field:
+            return None
+        with self.limit_execution():
+            stats = self.get_query().aggregate(latest=Max(self.freshness_field), count=Count('pk'))
+        token = json.dumps([self.get_fingerprint(file_type, user), stats['latest'], stats['count']], default=str)
+        return f'"{hashlib.sha256(token.encode()).hexdigest()}"'
+
+    def get_fresh_run(self, fingerprint):
+        """Return a stored run for fingerprint that is recent enough to be reused"""
+        max_age = getattr(settings, 'REPORT_BUILDER_ARTIFACT_MAX_AGE', 0)
+        if not max_age or not fingerprint:
+            return None
+        return (
+            self.runs.filter(
+                fingerprint=fingerprint,
+                created__gte=timezone.now() - datetime.timedelta(seconds=max_age),
+            )
+            .exclude(report_file='')
+            .first()
+        )
+
+    def build_report_file(self, chunks, title, header, widths, file_type):
+        """Render chunks into a file. Returns file name and content."""
         if file_type not in ["csv", "xlsx"]:
             raise ValueError("file_type must be 'csv' or 'xlsx'")
         data_export = DataExportMixin()
@@ -444,90 +829,537 @@ class Report(models.Model):
                     header,
                     widths,
                 )
-                file_name = generate_filename(title, '.csv')
-                self.report_file.save(
-                    file_name,
-                    ContentFile(csv_file.getvalue().encode()),
-                )
-            elif file_type == 'xlsx':
-                xlsx_file = data_export.list_to_xlsx_file(
-                    single_chunk,
-                    title,
-                    header,
-                    widths,
-                )
-                file_name = generate_filename(title, '.xlsx')
-                self.report_file.save(file_name, ContentFile(xlsx_file.read()))
-            self.report_file_creation = datetime.datetime.today()
-            self.save()
-            return
-        else:
-            zip_buffer = BytesIO()
-            with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
-                for index, chunk in enumerate(chunks):
-                    chunk_title = f'{title}_part{index + 1}.{file_type}'
-                    if file_type == 'csv':
-                        csv_file = data_export.list_to_csv_file(
-                            chunk,
-                            chunk_title,
-                            header,
-                            widths,
-                        )
-                        zip_file.writestr(chunk_title, csv_file.getvalue().encode())
-                    elif file_type == 'xlsx':
-                        xlsx_file = data_export.list_to_xlsx_file(
-                            chunk,
-                            chunk_title,
-                            header,
-                            widths,
-                        )
-                        zip_file.writestr(chunk_title, xlsx_file.read())
-            zip_filename = f'{title}.zip'
-            self.report_file.save(zip_filename, ContentFile(zip_buffer.getvalue()))
-            self.report_file_creation = datetime.datetime.today()
-            self.save()
-            if email_to:
-                for email in email_to:
-                    self.email_report(email=email)
-            elif getattr(settings, 'REPORT_BUILDER_EMAIL_NOTIFICATION', False):
-                if user and user.email:
-                    self.email_report(user=user)
+                return generate_filename(title, '.csv'), csv_file.getvalue().encode()
+            xlsx_file = data_export.list_to_xlsx_file(
+                single_chunk,
+                title,
+                header,
+                widths,
+            )
+            return generate_filename(title, '.xlsx'), xlsx_file.read()
+
+        zip_buffer = BytesIO()
+        with zipfile.ZipFile(zip_buffer, 'w') as zip_file:
+            for index, chunk in enumerate(chunks):
+                chunk_title = f'{title}_part{index + 1}.{file_type}'
+                if file_type == 'csv':
+                    csv_file = data_export.list_to_csv_file(
+                        chunk,
+                        chunk_title,
+                        header,
+                        widths,
+                    )
+                    zip_file.writestr(chunk_title, csv_file.getvalue().encode())
+                elif file_type == 'xlsx':
+                    xlsx_file = data_export.list_to_xlsx_file(
+                        chunk,
+                        chunk_title,
+                        header,
+                        widths,
+                    )
+                    zip_file.writestr(chunk_title, xlsx_file.read())
+        return f'{title}.zip', zip_buffer.getvalue()
+
+    def save_run(self, file_name, content, file_type, user=None, fingerprint='', row_count=None, latest=False):
+        """Store a generated file as a new run and prune old files. With
+        latest the run's file becomes report_file first, so it is pruned
+        instead of the previous one.
+        """
+        run = ReportRun(
+            report=self,
+            user=user,
+            fingerprint=fingerprint,
+            file_type=file_type,
+            row_count=row_count,
+        )
+        with run_stage('store'):
+            run.report_file.save(file_name, ContentFile(content), save=False)
+            run.save()
+            if latest:
+                self.set_latest_run(run)
+            self.prune_runs()
+        metrics = get_run_metrics()
+        if metrics:
+            metrics.run = run
+            metrics.byte_count = len(content)
+        return run
+
+    def prune_runs(self):
+        """Delete stored files beyond REPORT_BUILDER_ARTIFACT_RETENTION.
+        The run rows are kept as history. The file report_file points at is
+        always one of the kept files, as its link may have been emailed.
+        """
+        keep = max(getattr(settings, 'REPORT_BUILDER_ARTIFACT_RETENTION', 5), 1)
+        runs = self.runs.exclude(report_file='')
+        if self.report_file:
+            runs = runs.exclude(report_file=self.report_file.name)
+            keep -= 1
+        for run in runs[keep:]:
+            run.report_file.delete(save=False)
+            run.save(update_fields=['report_file'])
+
+    def set_latest_run(self, run):
+        """Point report_file at the file of run"""
+        self.report_file = run.report_file.name
+        self.report_file_creation = run.created
+        self.save(update_fields=['report_file', 'report_file_creation'])
+
+    def async_report_save(
+        self,
+        chunks,
+        title,
+        header,
+        widths,
+        user=None,
+        file_type=None,
+        email_to: str = None,
+        fingerprint='',
+    ):
+        with run_stage('encode'):
+            file_name, content = self.build_report_file(chunks, title, header, widths, file_type)
+        run = self.save_run(
+            file_name,
+            content,
+            file_type,
+            user=user,
+            fingerprint=fingerprint,
+            row_count=sum(len(chunk) for chunk in chunks),
+            latest=True,
+        )
+        self.notify(user, email_to)
+        return run
+
+    def notify(self, user=None, email_to: str = None):
+        if email_to:
+            from .tasks import report_builder_email_report
+
+            report_builder_email_report.delay(self.report_file.url, list(email_to))
+        elif getattr(settings, 'REPORT_BUILDER_EMAIL_NOTIFICATION', False):
+            if user and user.email:
+                self.email_report(user=user)
 
     @staticmethod
     def chunk_data(data, chunk_size):
         for i in range(0, len(data), chunk_size):
             yield data[i : i + chunk_size]
 
+    def iter_current_rows(self, user=None):
+        """Yield the rows a download would contain now, header first"""
+        display_fields = self.get_good_display_fields()
+        with self.limit_execution():
+            objects_list, message = DataExportMixin().report_to_list(
+                self.get_query(),
+                display_fields,
+                user,
+                preview=False,
+                grouped_rows=self.get_summary_rows(display_fields),
+            )
+        yield [display_field.name for display_field in display_fields]
+        yield from objects_list
+
+    def diff(self, key, old_run, new_run=None, user=None):
+        """Added, removed and changed rows between two stored runs, or
+        between old_run and the current data, matched by the key column.
+        See utils.diff_rows.
+        """
+        new_rows = new_run.iter_rows() if new_run else self.iter_current_rows(user)
+        limit = getattr(settings, 'REPORT_BUILDER_DIFF_MAX_ROWS', 1000)
+        return diff_rows(old_run.iter_rows, new_rows, key, limit=limit)
+
     def run_report(self, file_type, user=None, queryset=None, asynchronous=False, scheduled=False, email_to: str = None):
         """Generate this report file"""
-        if not queryset:
-            queryset = self.get_query()
+        if asynchronous and user is None:
+            raise Exception('Cannot run async report without a user')
 
-        display_fields = self.get_good_display_fields()
+        fingerprint = ''
+        if queryset is None:
+            fingerprint = self.get_fingerprint(file_type, user)
+            run = self.get_fresh_run(fingerprint)
+            if run is not None:
+                if scheduled or asynchronous:
+                    self.set_latest_run(run)
+                    self.notify(user, email_to)
+                    return run
+                return run.get_response()
+
+        trigger = ReportRun.SCHEDULED if scheduled else ReportRun.ASYNC if asynchronous else ReportRun.DOWNLOAD
+        with self.track_run(trigger, user, file_type, fingerprint) as metrics:
+            display_fields = self.get_good_display_fields()
+
+            data_export = DataExportMixin()
+            with self.limit_execution():
+                grouped_rows = None
+                if queryset is None:
+                    queryset = self.get_query()
+                    grouped_rows = self.get_summary_rows(display_fields)
+                elif self.get_database():
+                    queryset = queryset.using(self.get_database())
+                objects_list, message = data_export.report_to_list(
+                    queryset,
+                    display_fields,
+                    user,
+                    preview=False,
+                    grouped_rows=grouped_rows,
+                )
+            title = re.sub(r'\W+', '', self.name)[:30]
+            header = []
+            widths = []
+            for field in display_fields:
+                header.append(field.name)
+                widths.append(field.width)
 
-        data_export = DataExportMixin()
-        objects_list, message = data_export.report_to_list(queryset, display_fields, user, preview=False)
-        title = re.sub(r'\W+', '', self.name)[:30]
-        header = []
-        widths = []
-        for field in display_fields:
-            header.append(field.name)
-            widths.append(field.width)
-
-        chunk_size = 1000000
-        chunks = list(self.chunk_data(objects_list, chunk_size))
-
-        if scheduled:
-            self.async_report_save(chunks, title, header, widths, user, file_type)
-        elif asynchronous:
-            if user is None:
-                raise Exception('Cannot run async report without a user')
-            self.async_report_save(chunks, title, header, widths, user, file_type)
-        else:
-            if file_type == 'csv':
-                return data_export.list_to_csv_response(objects_list, title, header, widths)
+            chunk_size = 1000000
+            chunks = list(self.chunk_data(objects_list, chunk_size))
+
+            if scheduled or asynchronous:
+                return self.async_report_save(
+                    chunks,
+                    title,
+                    header,
+                    widths,
+                    user,
+                    file_type,
+                    email_to=email_to,
+                    fingerprint=fingerprint,
+                )
+            elif fingerprint and getattr(settings, 'REPORT_BUILDER_ARTIFACT_MAX_AGE', 0):
+                # Keep the file so the next download can be served from it
+                with run_stage('encode'):
+                    file_name, content = self.build_report_file(chunks, title, header, widths, file_type)
+                run = self.save_run(
+                    file_name,
+                    content,
+                    file_type,
+                    user=user,
+                    fingerprint=fingerprint,
+                    row_count=len(objects_list),
+                )
+                return run.get_response()
             else:
-                return data_export.list_to_xlsx_response(objects_list, title, header, widths)
+                with run_stage('encode'):
+                    if file_type == 'csv':
+                        response = data_export.list_to_csv_response(objects_list, title, header, widths)
+                    else:
+                        response = data_export.list_to_xlsx_response(objects_list, title, header, widths)
+                metrics.byte_count = len(response.content)
+                return response
+
+
+class ReportRun(models.Model):
+    """A report execution with its timings and sizes. Downloads also keep
+    the generated file and the fingerprint of the definition it was built from.
+    """
+
+    SUCCESS = 'success'
+    TIMEOUT = 'timeout'
+    ERROR = 'error'
+    CANCELLED = 'cancelled'
+    STATUS_CHOICES = (
+        (SUCCESS, 'Success'),
+        (TIMEOUT, 'Timed out'),
+        (ERROR, 'Error'),
+        (CANCELLED, 'Cancelled'),
+    )
+    PREVIEW = 'preview'
+    STREAM = 'stream'
+    DOWNLOAD = 'download'
+    ASYNC = 'async'
+    SCHEDULED = 'scheduled'
+    TRIGGER_CHOICES = (
+        (PREVIEW, 'Preview'),
+        (STREAM, 'Stream'),
+        (DOWNLOAD, 'Download'),
+        (ASYNC, 'Asynchronous download'),
+        (SCHEDULED, 'Scheduled'),
+    )
+
+    report = models.ForeignKey(Report, on_delete=models.CASCADE, related_name='runs')
+    user = models.ForeignKey(
+        AUTH_USER_MODEL,
+        blank=True,
+        null=True,
+        related_name="report_run_set",
+        on_delete=models.SET_NULL,
+    )
+    fingerprint = models.CharField(max_length=64, blank=True)
+    file_type = models.CharField(max_length=4, blank=True)
+    report_file = models.FileField(upload_to="report_files", blank=True)
+    row_count = models.PositiveIntegerField(blank=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=SUCCESS)
+    trigger = models.CharField(max_length=10, choices=TRIGGER_CHOICES, blank=True)
+    duration = models.FloatField(blank=True, null=True, help_text="Seconds")
+    timings = models.JSONField(
+        default=dict,
+        blank=True,
+        help_text="Seconds spent in each stage: query, properties, sort, format, encode and store",
+    )
+    byte_count = models.PositiveBigIntegerField(blank=True, null=True)
+    query_count = models.PositiveIntegerField(blank=True, null=True)
+    peak_memory = models.PositiveBigIntegerField(
+        blank=True,
+        null=True,
+        help_text="Bytes, with REPORT_BUILDER_TRACE_MEMORY",
+    )
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created', '-id']
+        indexes = [
+            models.Index(fields=['report', 'fingerprint', 'created']),
+            models.Index(fields=['created']),
+        ]
+
+    def __str__(self):
+        return f'{self.report} ({self.created})'
+
+    @classmethod
+    def prune_history(cls, days=None):
+        """Delete runs older than REPORT_BUILDER_RUN_HISTORY_DAYS, except the
+        ones still holding a file, which artifact retention clears first
+        """
+        if days is None:
+            days = getattr(settings, 'REPORT_BUILDER_RUN_HISTORY_DAYS', 90)
+        if not days:
+            return 0
+        old_runs = cls.objects.filter(created__lt=timezone.now() - datetime.timedelta(days=days), report_file='')
+        return old_runs.delete()[0]
+
+    @classmethod
+    def get_stats(cls, since=None, limit=None):
+        """Median and 95th percentile duration, rows and queries of the runs
+        of each report created since, the slowest reports first. Only the
+        latest limit runs are read, REPORT_BUILDER_RUN_STATS_MAX_RUNS by default.
+        """
+        if limit is None:
+            limit = getattr(settings, 'REPORT_BUILDER_RUN_STATS_MAX_RUNS', 100000)
+        runs = cls.objects.exclude(duration=None).order_by('-created')
+        if since is not None:
+            runs = runs.filter(created__gte=since)
+        by_report = {}
+        for report_id, status, duration, row_count, query_count in runs.values_list(
+            'report_id',
+            'status',
+            'duration',
+            'row_count',
+            'query_count',
+        )[:limit].iterator():
+            report_runs = by_report.setdefault(report_id, {'statuses': [], 'durations': [], 'rows': [], 'queries': []})
+            report_runs['statuses'].append(status)
+            report_runs['durations'].append(duration)
+            if row_count is not None:
+                report_runs['rows'].append(row_count)
+            if query_count is not None:
+                report_runs['queries'].append(query_count)
+        reports = Report.objects.in_bulk(by_report)
+        stats = []
+        for report_id, report_runs in by_report.items():
+            durations, rows, queries = (sorted(report_runs[key]) for key in ('durations', 'rows', 'queries'))
+            stats.append(
+                {
+                    'report': reports[report_id],
+                    'runs': len(durations),
+                    'timeouts': report_runs['statuses'].count(cls.TIMEOUT),
+                    'errors': report_runs['statuses'].count(cls.ERROR),
+                    'p50': percentile(durations, 0.5),
+                    'p95': percentile(durations, 0.95),
+                    'max': durations[-1],
+                    'rows_p50': percentile(rows, 0.5),
+                    'rows_p95': percentile(rows, 0.95),
+                    'queries_p50': percentile(queries, 0.5),
+                    'queries_p95': percentile(queries, 0.95),
+                },
+            )
+        return sorted(stats, key=lambda row: row['p95'], reverse=True)
+
+    def iter_rows(self):
+        """Yield the rows of the stored file, header first"""
+        with self.report_file.open('rb') as file:
+            yield from iter_file_rows(file, self.file_type, zipped=self.report_file.name.endswith('.zip'))
+
+    def get_response(self):
+        """Serve the stored file as a download"""
+        return FileResponse(
+            self.report_file.open('rb'),
+            as_attachment=True,
+            filename=os.path.basename(self.report_file.name),
+        )
+
+
+class ReportSummary(models.Model):
+    """Stored group-by rows of a report, refreshed incrementally.
+
+    Each refresh only aggregates root model rows whose watermark field is
+    greater than the one seen last time and merges them into the stored rows.
+    Rows that are changed or deleted afterwards are not picked up, so this is
+    meant for append-mostly tables.
+    """
+
+    MERGEABLE_AGGREGATES = ('Sum', 'Count', 'Max', 'Min', 'Avg')
+
+    report = models.OneToOneField(Report, on_delete=models.CASCADE, related_name='summary')
+    watermark_field = models.CharField(
+        max_length=2000,
+        help_text="Root model field that only grows for new rows, e.g. id or created.",
+    )
+    watermark = models.JSONField(blank=True, null=True, editable=False, encoder=DjangoJSONEncoder)
+    fingerprint = models.CharField(max_length=64, blank=True, editable=False)
+    rows = models.JSONField(default=dict, blank=True, editable=False, encoder=DjangoJSONEncoder)
+    refreshed = models.DateTimeField(blank=True, null=True, editable=False)
+
+    class Meta:
+        verbose_name_plural = "report summaries"
+
+    def __str__(self):
+        return str(self.report)
+
+    def clean(self):
+        try:
+            self.report.root_model_class._meta.get_field(self.watermark_field)
+        except FieldDoesNotExist:
+            raise ValidationError({'watermark_field': 'Must be a field of the root model.'}) from None
+        return super().clean()
+
+    @staticmethod
+    def _state_keys(display_field):
+        """Keys of the values stored for a display field"""
+        key = display_field.field_key + '__' + display_field.aggregate.lower()
+        if display_field.aggregate == 'Avg':
+            return [key + ':sum', key + ':count']
+        return [key]
+
+    def is_supported(self, display_fields):
+        report = self.report
+        if report.distinct or not any(df.group for df in display_fields):
+            return False
+        for display_field in display_fields:
+            if display_field.field_type in ('Property', 'Custom Field', 'Invalid'):
+                return False
+            if not display_field.group and display_field.aggregate not in self.MERGEABLE_AGGREGATES:
+                return False
+        for filter_field in report.filterfield_set.all():
+            # These depend on the current time or on all rows at once
+            if filter_field.filter_type in ('relative_range', 'max', 'min'):
+                return False
+        return True
+
+    def get_rows(self, display_fields):
+        """Refresh and return rows shaped like values(*group).annotate(...)"""
+        display_fields = list(display_fields)
+        for display_field in display_fields:
+            if not display_field.group and not display_field.aggregate:
+                display_field.aggregate = 'Max'
+        if not self.is_supported(display_fields):
+            return None
+        self.refresh(display_fields)
+
+        group = [df for df in display_fields if df.group]
+        aggregated = [df for df in display_fields if not df.group]
+        root_model = self.report.root_model_class
+        model_fields = {
+            df.field_key: get_model_from_path_string(root_model, df.path)._meta.get_field(df.field)
+            for df in display_fields
+        }
+
+        rows = []
+        for key in sorted(self.rows):
+            states = self.rows[key]
+            row = {}
+            for df, value in zip(group, json.loads(key), strict=True):
+                row[df.field_key] = model_fields[df.field_key].to_python(value)
+            for df in aggregated:
+                state_keys = self._state_keys(df)
+                if df.aggregate == 'Avg':
+                    total, count = (states.get(state_key) for state_key in state_keys)
+                    total = model_fields[df.field_key].to_python(total)
+                    if not count or total is None:
+                        value = None
+                    elif isinstance(total, Decimal):
+                        value = total / count
+                    else:
+                        value = float(total) / count
+                elif df.aggregate == 'Count':
+                    value = states.get(state_keys[0]) or 0
+                else:
+                    value = model_fields[df.field_key].to_python(states.get(state_keys[0]))
+                row[state_keys[0].split(':')[0]] = value
+            rows.append(row)
+        return rows
+
+    def refresh(self, display_fields):
+        """Aggregate rows added since the last refresh into the stored rows"""
+        agg_funcs = {'Sum': Sum, 'Count': Count, 'Max': Max, 'Min': Min}
+        root_model = self.report.root_model_class
+        fingerprint = hashlib.sha256(
+            (self.report.get_fingerprint('summary') + self.watermark_field).encode(),
+        ).hexdigest()
+
+        with transaction.atomic(using=router.db_for_write(ReportSummary)):
+            summary = ReportSummary.objects.select_for_update().get(pk=self.pk)
+            if summary.fingerprint != fingerprint:
+                # The definition changed, start over
+                summary.rows = {}
+                summary.watermark = None
+                summary.fingerprint = fingerprint
+
+            queryset = self.report.get_query()
+            new_watermark = queryset.aggregate(watermark=Max(self.watermark_field))['watermark']
+            if new_watermark is not None:
+                queryset = queryset.filter(**{self.watermark_field + '__lte': new_watermark})
+                if summary.watermark is not None:
+                    watermark_field = root_model._meta.get_field(self.watermark_field)
+                    queryset = queryset.filter(
+                        **{self.watermark_field + '__gt': watermark_field.to_python(summary.watermark)},
+                    )
+
+                group = [df.field_key for df in display_fields if df.group]
+                annotations = {}
+                states = {}
+                for i, display_field in enumerate(display_fields):
+                    if display_field.group:
+                        continue
+                    model_field = get_model_from_path_string(root_model, display_field.path)._meta.get_field(
+                        display_field.field,
+                    )
+                    for j, state_key in enumerate(self._state_keys(display_field)):
+                        if display_field.aggregate == 'Avg':
+                            aggregate = 'Sum' if j == 0 else 'Count'
+                        else:
+                            aggregate = display_field.aggregate
+                        alias = f'report_builder_summary_{i}_{j}'
+                        annotations[alias] = agg_funcs[aggregate](display_field.field_key)
+                        states[alias] = (state_key, aggregate, model_field)
+
+                for values in queryset.values(*group).annotate(**annotations):
+                    key = json.dumps([values[field] for field in group], cls=DjangoJSONEncoder)
+                    row = summary.rows.setdefault(key, {})
+                    for alias, (state_key, aggregate, model_field) in states.items():
+                        row[state_key] = self._merge(aggregate, model_field, row.get(state_key), values[alias])
+                summary.rows = json.loads(json.dumps(summary.rows, cls=DjangoJSONEncoder))
+                summary.watermark = json.loads(json.dumps(new_watermark, cls=DjangoJSONEncoder))
+
+            summary.refreshed = timezone.now()
+            summary.save()
+
+        self.rows = summary.rows
+        self.watermark = summary.watermark
+        self.fingerprint = summary.fingerprint
+        self.refreshed = summary.refreshed
+
+    @staticmethod
+    def _merge(aggregate, model_field, stored, new):
+        """Combine a stored aggregate state with one computed over new rows"""
+        if new is None:
+            return stored
+        if stored is None:
+            return new
+        if aggregate == 'Count':
+            return stored + new
+        stored = model_field.to_python(stored)
+        if aggregate == 'Sum':
+            return stored + new
+        if aggregate == 'Max':
+            return max(stored, new)
+        return min(stored, new)
 
 
 class Format(models.Model):
@@ -664,9 +1496,12 @@ class FilterField(AbstractField):
         if self.filter_type == 'range' and self.filter_value2 in [None, '']:
             raise ValidationError('Range filters must have two values')
 
+        # Resolving the field type walks the relation path, do it once
+        field_type = None if self.filter_type in ('max', 'min') else self.field_type
+
         # Raise error if 'relative_range' filter is applied to a non-supported
         # field type
-        if self.filter_type == 'relative_range' and self.field_type not in dt_types:
+        if self.filter_type == 'relative_range' and field_type not in dt_types:
             raise ValidationError(
                 'Relative Range filtering is only currently supported for' f' the following field types: {dt_types}.',
             )
@@ -680,7 +1515,7 @@ class FilterField(AbstractField):
             pass
 
         # clean DateTimeField inputs
-        elif self.field_type == 'DateField' and self.filter_type != 'isnull':
+        elif field_type == 'DateField' and self.filter_type != 'isnull':
             self.filter_value = str(self.parse_datetime_fields(self.filter_value))
 
         return super().clean()
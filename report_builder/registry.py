@@ -0,0 +1,298 @@
+"""Per-model metadata used by the field browser.
+
+Model classes do not change while the process runs, so their fields,
+relations, properties and ReportBuilder options are introspected once and
+kept here. Custom fields live in the database and are not cached.
+"""
+
+import hashlib
+import threading
+from functools import cache
+
+from django.apps import apps
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.utils.functional import cached_property
+
+from .utils import clear_path_string_cache, get_all_field_names, get_direct_fields_from_model, get_properties_from_model
+
+
+PROPERTY_HELP_TEXT = 'Adding this property will significantly increase the time it takes to run a report.'
+
+
+class ModelInfo:
+    """Introspected metadata of one model"""
+
+    def __init__(self, model):
+        self.model = model
+        meta = getattr(model, 'ReportBuilder', None)
+        self.fields = getattr(meta, 'fields', None)
+        self.exclude = getattr(meta, 'exclude', None)
+        self.filters = getattr(meta, 'filters', None)
+        self.defaults = getattr(meta, 'defaults', None)
+        self.extra = getattr(meta, 'extra', None)
+        if self.fields is not None:
+            self.fields = list(self.fields)
+        if self.extra is not None:
+            self.extra = list(self.extra)
+
+    def is_default(self, name):
+        return self.defaults is None or name in self.defaults
+
+    def can_filter(self, name):
+        return self.filters is None or name in self.filters
+
+    @cached_property
+    def direct_fields(self):
+        # External packages might cause duplicates
+        return list(dict.fromkeys(get_direct_fields_from_model(self.model)))
+
+    @cached_property
+    def properties(self):
+        return get_properties_from_model(self.model)
+
+    @cached_property
+    def relation_fields(self):
+        """Relation fields (m2m, fk and reverse fk) as (field_name, field)"""
+        relations = []
+        all_fields_names = get_all_field_names(self.model)
+        for field_name in all_fields_names:
+            field = self.model._meta.get_field(field_name)
+            # get_all_field_names returns the same field both with and without _id
+            if field_name[-3:] == '_id' and field_name[:-3] in all_fields_names:
+                continue
+            if field.many_to_many or not field.concrete or field.is_relation:
+                relations.append((field_name, field))
+        return relations
+
+    @cached_property
+    def visible_fields(self):
+        """Direct fields left after the ReportBuilder fields and exclude options"""
+        fields = self.direct_fields
+        if self.fields is not None:
+            fields = [field for field in fields if field.name in self.fields]
+        if self.exclude is not None:
+            fields = [field for field in fields if field.name not in self.exclude]
+        return fields
+
+    @cached_property
+    def field_rows(self):
+        """Field browser rows for direct fields and properties, without paths"""
+        rows = []
+        for field in self.visible_fields:
+            rows.append(
+                {
+                    'name': field.name,
+                    'field': field.name,
+                    'field_verbose': getattr(field, 'verbose_name', None) or field.get_accessor_name(),
+                    'field_type': field.get_internal_type(),
+                    'is_default': self.is_default(field.name),
+                    'field_choices': field.choices,
+                    'can_filter': self.can_filter(field.name),
+                    'help_text': field.help_text,
+                },
+            )
+        if self.fields is not None or self.extra is not None:
+            if self.fields and self.extra:
+                extra_fields = list(set(self.fields + self.extra))
+            elif self.fields is not None:
+                extra_fields = self.fields
+            else:
+                extra_fields = self.extra
+            for name in extra_fields:
+                if isinstance(getattr(self.model, name, None), property | cached_property):
+                    rows.append(
+                        {
+                            'name': name,
+                            'field': name,
+                            'field_verbose': name,
+                            'field_type': 'Property',
+                            'field_choices': None,
+                            'can_filter': self.can_filter(name),
+                            'is_default': self.is_default(name),
+                            'help_text': PROPERTY_HELP_TEXT,
+                        },
+                    )
+        return rows
+
+    @cached_property
+    def relation_rows(self):
+        """Field browser rows for relations, without paths and include status"""
+        rows = []
+        for field_name, field in self.relation_fields:
+            split_name = field.name.split(':')
+            if len(split_name) == 1:
+                app_label = False
+                model_name = split_name[0]
+                model_information = model_name
+            else:
+                app_label, model_name = split_name[0], split_name[1]
+                model_information = app_label + "." + model_name
+            verbose_name = getattr(field, 'verbose_name', None)
+            if verbose_name is None:
+                verbose_name = field.get_accessor_name()
+            rows.append(
+                {
+                    'field_name': field_name,
+                    'verbose_name': verbose_name,
+                    'help_text': getattr(field, 'help_text', ''),
+                    'parent_model_name': model_name,
+                    'parent_model_app_label': app_label,
+                    'model_information': model_information,
+                },
+            )
+        return rows
+
+
+_registry = {}
+_lock = threading.Lock()
+
+
+def get_model_info(model):
+    """Return the cached ModelInfo of a model class"""
+    try:
+        return _registry[model]
+    except KeyError:
+        with _lock:
+            return _registry.setdefault(model, ModelInfo(model))
+
+
+def clear_registry(**kwargs):
+    """Forget everything cached about models, e.g. after migrations"""
+    _registry.clear()
+    _field_trees.clear()
+    clear_allowed_models()
+    get_schema_version.cache_clear()
+    clear_path_string_cache()
+
+
+def clear_registry_on_setting_changed(setting, **kwargs):
+    """Forget cached model information when a setting it reads changes, e.g. in tests"""
+    if setting.startswith('REPORT_BUILDER_') or setting == 'INSTALLED_APPS':
+        clear_registry()
+
+
+@cache
+def get_schema_version():
+    """Hash of every installed model's fields and ReportBuilder options.
+    Only changes when the code does, e.g. on deploy.
+    """
+    digest = hashlib.sha256()
+    for model in sorted(apps.get_models(), key=lambda model: model._meta.label):
+        info = get_model_info(model)
+        digest.update(model._meta.label.encode())
+        # Field order follows a set, sort it so every process agrees
+        digest.update(repr(sorted(field.name for field in info.direct_fields)).encode())
+        digest.update(repr(sorted(field_name for field_name, field in info.relation_fields)).encode())
+        digest.update(repr([info.fields, info.exclude, info.filters, info.defaults, info.extra]).encode())
+    return digest.hexdigest()
+
+
+_allowed_models = {}
+
+
+def _get_allowed_state():
+    """Include/exclude sets for the current settings, rebuilt when the
+    settings objects are replaced.
+    """
+    include = getattr(settings, 'REPORT_BUILDER_INCLUDE', None)
+    exclude = getattr(settings, 'REPORT_BUILDER_EXCLUDE', None)
+    state = _allowed_models.get('state')
+    if state is None or state['include'] is not include or state['exclude'] is not exclude:
+        state = {
+            'include': include,
+            'exclude': exclude,
+            'includes': frozenset(include or ()),
+            'excludes': frozenset(exclude or ()),
+        }
+        _allowed_models['state'] = state
+    return state
+
+
+def clear_allowed_models(**kwargs):
+    """Forget the allowed models, e.g. after migrations add content types"""
+    _allowed_models.clear()
+
+
+def is_included(model_name, model_information):
+    """Whether a relation's model passes REPORT_BUILDER_INCLUDE/EXCLUDE,
+    checked both as 'foo' and as 'demo_models.foo'.
+    """
+    state = _get_allowed_state()
+    if state['includes'] and model_name not in state['includes'] and model_information not in state['includes']:
+        return False
+    if model_name in state['excludes'] or model_information in state['excludes']:
+        return False
+    return True
+
+
+def get_allowed_model_keys():
+    """Return the (app_label, model) keys and pks of content types allowed
+    as report root models. Computed once per settings and migration.
+    """
+    state = _get_allowed_state()
+    if 'keys' not in state:
+        keys = set()
+        pks = set()
+        for pk, app_label, model in ContentType.objects.values_list('pk', 'app_label', 'model'):
+            if is_included(model, f'{app_label}.{model}'):
+                keys.add((app_label, model))
+                pks.add(pk)
+        state['pks'] = frozenset(pks)
+        state['keys'] = frozenset(keys)
+    return state['keys'], state['pks']
+
+
+_field_trees = {}
+
+
+def get_field_tree(model, depth):
+    """Fields and relations reachable from a model, following relations
+    depth levels deep. Relations back to a model already on the path and
+    relations to excluded models are not expanded.
+    """
+    key = (
+        model,
+        depth,
+        repr(getattr(settings, 'REPORT_BUILDER_INCLUDE', None)),
+        repr(getattr(settings, 'REPORT_BUILDER_EXCLUDE', None)),
+    )
+    try:
+        return _field_trees[key]
+    except KeyError:
+        tree = _build_field_tree(model, depth, '', '', (model,))
+        with _lock:
+            return _field_trees.setdefault(key, tree)
+
+
+def _build_field_tree(model, depth, path, path_verbose, ancestors):
+    info = get_model_info(model)
+    model_id = ContentType.objects.get_for_model(model).id
+    relations = []
+    related_fields = dict(info.relation_fields)
+    for row in info.relation_rows:
+        row = dict(row, path=path, model_id=model_id)
+        row['included_model'] = is_included(row['parent_model_name'], row.pop('model_information'))
+        related_model = related_fields[row['field_name']].related_model
+        row['cycle'] = related_model in ancestors
+        row['children'] = None
+        if (
+            depth > 0
+            and related_model is not None
+            and not row['cycle']
+            and is_included(related_model._meta.model_name, related_model._meta.label_lower)
+        ):
+            row['children'] = _build_field_tree(
+                related_model,
+                depth - 1,
+                path + row['field_name'] + '__',
+                related_model.__name__.lower(),
+                ancestors + (related_model,),
+            )
+        relations.append(row)
+    return {
+        'model_id': model_id,
+        'path': path,
+        'fields': [dict(row, path=path, path_verbose=path_verbose) for row in info.field_rows],
+        'relations': relations,
+    }
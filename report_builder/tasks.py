@@ -1,10 +1,42 @@
 from celery import shared_task
+from django.conf import settings
 
 
 @shared_task
 def report_builder_file_async_report_save(report_id, user_id, file_type):
-    """Start a report task"""
+    """Start a report task. Returns the id of the stored run."""
     from .views import DownloadFileView
 
     view = DownloadFileView()
-    view.process_report(report_id, user_id, file_type, to_response=False)
+    run = view.process_report(report_id, user_id, file_type, to_response=False)
+    return run.pk
+
+
+@shared_task
+def report_builder_refresh_summaries():
+    """Bring every report summary up to date."""
+    from .models import ReportSummary
+
+    for summary in ReportSummary.objects.select_related('report'):
+        display_fields = summary.report.get_good_display_fields()
+        summary.get_rows(display_fields)
+
+
+@shared_task
+def report_builder_prune_run_history():
+    """Delete report runs older than REPORT_BUILDER_RUN_HISTORY_DAYS."""
+    from .models import ReportRun
+
+    ReportRun.prune_history()
+
+
+@shared_task(bind=True, default_retry_delay=60)
+def report_builder_email_report(self, report_url, emails):
+    """Email a report file to a list of addresses over one connection.
+    Only the addresses that failed are retried.
+    """
+    from .email import email_reports
+
+    failed = email_reports(report_url, emails)
+    if failed:
+        raise self.retry(args=(report_url, failed), max_retries=getattr(settings, 'REPORT_BUILDER_EMAIL_RETRIES', 3))
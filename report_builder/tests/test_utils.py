@@ -1,16 +1,30 @@
+import os
+import subprocess
+import sys
+from unittest import mock
+
+from django.apps import apps
 from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.test import TestCase
+from django.db import DEFAULT_DB_ALIAS, connection
+from django.db.models.signals import post_migrate
+from django.test import TestCase, override_settings
 
-from report_builder_demo.demo_models.models import Bar, Comment, Place, Restaurant, Waiter
+from report_builder_demo.demo_models.models import Bar, Comment, Foo, FooExclude, Place, Restaurant, Waiter
 
 from ..mixins import GetFieldsMixin
-from ..models import DisplayField, FilterField, Report
+from ..models import DisplayField, FilterField, Format, Report
+from ..registry import get_model_info
 from ..utils import (
+    ReportTimeoutError,
+    clear_path_string_cache,
+    format_row,
     get_direct_fields_from_model,
     get_model_from_path_string,
+    get_models_from_path_strings,
     get_properties_from_model,
     get_relation_fields_from_model,
+    statement_timeout,
 )
 
 
@@ -69,17 +83,66 @@ class UtilityFunctionTests(TestCase):
         self.assertTrue('displayfield' in names or 'report_builder:displayfield' in names)
         self.assertTrue('filterfield' in names or 'report_builder:filterfield' in names)
         self.assertTrue('root_model' in names)
-        self.assertEqual(len(names), 7)
+        self.assertEqual(len(names), 9)
 
     def test_get_model_from_path_string(self):
         result = get_model_from_path_string(Restaurant, 'waiter__name')
         self.assertEqual(result, Waiter)
 
+    def test_get_models_from_path_strings(self):
+        result = get_models_from_path_strings(Restaurant, ['waiter__name', 'place__serves_pizza', '', 'waiter__name'])
+        self.assertEqual(result, {'waiter__name': Waiter, 'place__serves_pizza': Place, '': Restaurant})
+        # Memoized once apps are ready
+        clear_path_string_cache()
+        with mock.patch.object(Restaurant._meta, 'get_field', wraps=Restaurant._meta.get_field) as get_field:
+            for _i in range(2):
+                self.assertIs(get_model_from_path_string(Restaurant, 'waiter__name'), Waiter)
+                self.assertEqual(get_models_from_path_strings(Restaurant, ['waiter__name']), {'waiter__name': Waiter})
+        get_field.assert_called_once_with('waiter')
+
+    def test_caches_cleared_by_signals(self):
+        def warm():
+            get_model_from_path_string(Restaurant, 'waiter__name')
+            return get_model_info(Bar)
+
+        def assert_cleared(info):
+            # Stale entries are dropped, lookups resolve the fields again
+            self.assertIsNot(get_model_info(Bar), info)
+            with mock.patch.object(Restaurant._meta, 'get_field', wraps=Restaurant._meta.get_field) as get_field:
+                self.assertIs(get_model_from_path_string(Restaurant, 'waiter__name'), Waiter)
+            get_field.assert_called_once_with('waiter')
+
+        info = warm()
+        with override_settings(REPORT_BUILDER_EXCLUDE=['demo_models.foo']):
+            assert_cleared(info)
+
+        info = warm()
+        config = apps.get_app_config('report_builder')
+        post_migrate.send(
+            sender=config,
+            app_config=config,
+            verbosity=0,
+            interactive=False,
+            using=DEFAULT_DB_ALIAS,
+            apps=apps,
+            plan=[],
+        )
+        assert_cleared(info)
+
     def test_get_model_from_path_string_one_to_one(self):
         """Test that one-to-one relationships don't break this function"""
         result = get_model_from_path_string(Restaurant, 'place__serves_pizza')
         self.assertEqual(result, Place)
 
+    def test_format_row(self):
+        choice_lists = {0: {'CH': 'CHECK', '': '', None: ''}}
+        display_formats = {1: Format(string='${:,.2f}')}
+        self.assertEqual(format_row(['CH', 7], choice_lists, display_formats), ['CHECK', '$7.00'])
+        # Unknown and unhashable choices read as text, bad formats are left as is
+        self.assertEqual(format_row(['XX', 'x'], choice_lists, display_formats), ['XX', 'x'])
+        self.assertEqual(format_row([['CH'], None], choice_lists, {}), ["['CH']", None])
+        self.assertEqual(format_row([None, 1], choice_lists, {}), ['', 1])
+
     def test_get_direct_fields_from_model(self):
         fields = get_direct_fields_from_model(Report)
         names = self.get_fields_names(fields)
@@ -87,7 +150,7 @@ class UtilityFunctionTests(TestCase):
         self.assertTrue('description' in names)
         self.assertTrue('distinct' in names)
         self.assertTrue('id' in names)
-        self.assertEqual(len(names), 9)
+        self.assertEqual(len(names), 12)
 
     def test_get_fields(self):
         """Test GetFieldsMixin.get_fields"""
@@ -97,6 +160,40 @@ class UtilityFunctionTests(TestCase):
             "foos",
         )
 
+    def test_model_info(self):
+        info = get_model_info(Bar)
+        self.assertIs(get_model_info(Bar), info)
+        rows = {row['name']: row for row in info.field_rows}
+        self.assertEqual(rows['i_need_char_field']['field_type'], 'Property')
+        self.assertTrue(rows['char_field']['can_filter'])
+        self.assertFalse(rows['check_mate_status']['can_filter'])
+        self.assertEqual(
+            sorted(row['field_name'] for row in info.relation_rows),
+            sorted(field.field_name for field in get_relation_fields_from_model(Bar)),
+        )
+        self.assertEqual([field.name for field in get_model_info(Foo).visible_fields], ['char_field'])
+        self.assertNotIn('char_field2', [field.name for field in get_model_info(FooExclude).visible_fields])
+
+    def test_schema_version_across_processes(self):
+        script = (
+            "import sys; sys.argv = ['manage.py', 'test']; import django; django.setup(); "
+            "from report_builder.registry import get_schema_version; print(get_schema_version())"
+        )
+        versions = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed, DJANGO_SETTINGS_MODULE='report_builder_demo.settings')
+            result = subprocess.run(
+                [sys.executable, '-c', script],
+                capture_output=True,
+                check=True,
+                cwd=settings.BASE_DIR,
+                env=env,
+                text=True,
+            )
+            versions.add(result.stdout.strip())
+        # Field order must not depend on the hash seed of the process
+        self.assertEqual(len(versions), 1)
+
     def test_get_gfk_fields_from_model(self):
         get_direct_fields_from_model(Comment)
 
@@ -130,3 +227,16 @@ class UtilityFunctionTests(TestCase):
             objects = self.report.get_query()
             # expect custom manager to return correct object with filters
             self.assertEqual(objects[0], self.report)
+
+    def test_statement_timeout(self):
+        query = (
+            'WITH RECURSIVE counter(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM counter LIMIT 100000000) '
+            'SELECT COUNT(*) FROM counter'
+        )
+        with self.assertRaises(ReportTimeoutError):
+            with statement_timeout(1):
+                with connection.cursor() as cursor:
+                    cursor.execute(query)
+        # The connection is usable again afterwards
+        with statement_timeout(1000):
+            self.assertEqual(Report.objects.count(), 1)
@@ -1,3 +1,6 @@
+import smtplib
+from unittest import mock
+
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core import mail
@@ -5,8 +8,9 @@ from django.test import TestCase
 from django.test.utils import override_settings
 from model_bakery import baker
 
-from report_builder.tasks import report_builder_file_async_report_save
+from report_builder.tasks import report_builder_email_report, report_builder_file_async_report_save
 
+from .. import email
 from ..email import email_report
 
 
@@ -24,6 +28,62 @@ class ViewTests(TestCase):
         settings.REPORT_BUILDER_EMAIL_NOTIFICATION = None
         mail.outbox = []
 
+    def test_email_reports_over_one_connection(self):
+        report_url = 'http://fakeurl.com/fakestuffs'
+        emails = ['a@example.com', 'b@example.com', 'c@example.com']
+        with mock.patch.object(email, 'get_connection', wraps=email.get_connection) as get_connection:
+            with mock.patch.object(email, 'render_report_email', wraps=email.render_report_email) as render:
+                report_builder_email_report.delay(report_url, emails)
+        get_connection.assert_called_once_with()
+        render.assert_called_once_with(report_url)
+        self.assertEqual([message.to for message in mail.outbox], [[address] for address in emails])
+
+    def test_email_reports_retry_failed_recipients(self):
+        report_url = 'http://fakeurl.com/fakestuffs'
+        send = mail.EmailMessage.send
+        attempts = []
+
+        def flaky_send(message, *args, **kwargs):
+            attempts.append(message.to[0])
+            if attempts.count('b@example.com') == 1 and message.to == ['b@example.com']:
+                raise smtplib.SMTPServerDisconnected()
+            return send(message, *args, **kwargs)
+
+        with mock.patch.object(mail.EmailMessage, 'send', flaky_send):
+            report_builder_email_report.apply(args=(report_url, ['a@example.com', 'b@example.com']))
+        self.assertEqual(attempts, ['a@example.com', 'b@example.com', 'b@example.com'])
+        self.assertEqual([message.to for message in mail.outbox], [['a@example.com'], ['b@example.com']])
+
+    def test_email_reports_drop_refused_recipients(self):
+        report_url = 'http://fakeurl.com/fakestuffs'
+        send = mail.EmailMessage.send
+        attempts = []
+
+        def refusing_send(message, *args, **kwargs):
+            attempts.append(message.to[0])
+            if message.to == ['b@example.com']:
+                raise smtplib.SMTPRecipientsRefused({'b@example.com': (550, b'No such user')})
+            return send(message, *args, **kwargs)
+
+        with mock.patch.object(mail.EmailMessage, 'send', refusing_send):
+            report_builder_email_report.apply(args=(report_url, ['a@example.com', 'b@example.com', 'c@example.com']))
+        self.assertEqual(attempts, ['a@example.com', 'b@example.com', 'c@example.com'])
+        self.assertEqual([message.to for message in mail.outbox], [['a@example.com'], ['c@example.com']])
+
+    @override_settings(REPORT_BUILDER_EMAIL_RETRIES=1)
+    def test_email_reports_retries_setting(self):
+        report_url = 'http://fakeurl.com/fakestuffs'
+        attempts = []
+
+        def failing_send(message, *args, **kwargs):
+            attempts.append(message.to[0])
+            raise smtplib.SMTPServerDisconnected()
+
+        with mock.patch.object(mail.EmailMessage, 'send', failing_send):
+            result = report_builder_email_report.apply(args=(report_url, ['a@example.com']))
+        self.assertEqual(attempts, ['a@example.com', 'a@example.com'])
+        self.assertFalse(result.successful())
+
     def test_email_report_with_template(self):
         settings.REPORT_BUILDER_EMAIL_NOTIFICATION = True
         report_url = 'http://fakeurl.com/fakestuffs'
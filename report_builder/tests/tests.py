@@ -1,25 +1,48 @@
 import csv
 import json
+import threading
 import time
 import unittest
+import warnings
+from contextlib import contextmanager, nullcontext
 from datetime import date, datetime, timedelta
 from datetime import time as dtime
 from io import StringIO
+from unittest import mock
 
+from custom_field.custom_field import CustomFieldModel
+from custom_field.models import CustomField, CustomFieldValue
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.paginator import UnorderedObjectListWarning
+from django.db import connection
 from django.db.models.query import QuerySet
-from django.test import TestCase
-from django.test.utils import override_settings
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
+from django.utils import timezone
 from freezegun import freeze_time
+from rest_framework import serializers
 from rest_framework.test import APIClient
 
-from report_builder.api.serializers import ReportNestedSerializer
-from report_builder_demo.demo_models.models import Bar, Child, Person, Place, Restaurant, Waiter
+from report_builder.api.serializers import ReportNestedSerializer, ReportSerializer
+from report_builder_demo.demo_models.models import Bar, Child, Comment, Person, Place, Restaurant, Waiter
 
-from ..models import DisplayField, FilterField, Format, Report, get_allowed_models, get_limit_choices_to_callable
+from ..mixins import DataExportMixin
+from ..models import (
+    DisplayField,
+    FilterField,
+    Format,
+    Report,
+    ReportRun,
+    ReportSummary,
+    get_allowed_models,
+    get_limit_choices_to_callable,
+)
+from ..tasks import report_builder_prune_run_history
+from ..utils import ReportTimeoutError, load_custom_values
 
 
 User = get_user_model()
@@ -68,6 +91,7 @@ class ReportBuilderTests(TestCase):
         self.assertEqual(pre_exclude_duplicates, ['bar'])
         self.assertEqual(post_exclude_duplicates, [])
 
+    @override_settings(REPORT_BUILDER_INCLUDE=None)
     def test_get_allowed_models_lookup_dict(self):
         settings.REPORT_BUILDER_INCLUDE = (
             'demo_models.bar',
@@ -79,7 +103,19 @@ class ReportBuilderTests(TestCase):
 
         self.assertTrue(callable(get_limit_choices_to_callable))
         self.assertTrue(isinstance(lookup_dict['pk__in'], QuerySet))
-        self.assertQuerySetEqual(lookup_dict['pk__in'], map(repr, models), ordered=False)
+        self.assertQuerySetEqual(lookup_dict['pk__in'], models, ordered=False)
+        self.assertEqual(models.count(), 3)
+
+        foo = ContentType.objects.get(app_label='demo_models', model='foo')
+        person = ContentType.objects.get(app_label='demo_models', model='person')
+        field = ReportSerializer().fields['root_model']
+        self.assertEqual(field.to_internal_value(foo.pk), foo)
+        # Allowed pks and content types are cached, later checks do not query
+        with self.assertNumQueries(0):
+            self.assertEqual(field.to_internal_value(str(foo.pk)), foo)
+        for value in (person.pk, 0, 'foo', True, None):
+            with self.assertRaises(serializers.ValidationError):
+                field.to_internal_value(value)
 
     def test_report_builder_reports(self):
         url = '/report_builder/api/reports/'
@@ -92,6 +128,72 @@ class ReportBuilderTests(TestCase):
         response = self.client.get(url)
         self.assertEqual(response.status_code, 200)
 
+    def test_report_builder_reports_queries(self):
+        url = '/report_builder/api/reports/'
+        user = User.objects.get(username='testy')
+        ct = ContentType.objects.get_for_model(Report)
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            return len(queries)
+
+        Report.objects.create(name='first', root_model=ct, user_created=user).starred.add(user)
+        queries = count_queries()
+        for i in range(5):
+            Report.objects.create(name=f'report {i}', description='other', root_model=ct, user_created=user)
+        self.assertEqual(count_queries(), queries)
+
+        response = self.client.get(url)
+        starred = {report['name']: report['is_starred'] for report in response.data}
+        self.assertEqual(starred['first'], True)
+        self.assertEqual(starred['report 0'], False)
+
+        Report.objects.create(name='report 1', root_model=ct, user_created=user)
+        names = ['first', 'report 0', 'report 1', 'report 1', 'report 2', 'report 3', 'report 4']
+        self.assertEqual([report['name'] for report in self.client.get(url).data], names)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', UnorderedObjectListWarning)
+            pages = [self.client.get(url, {'page_size': 2, 'page': page}).data for page in (1, 2, 3, 4)]
+        self.assertEqual(pages[1]['count'], 7)
+        self.assertEqual([report['name'] for page in pages for report in page['results']], names)
+        self.assertEqual(len({report['id'] for page in pages for report in page['results']}), 7)
+        response = self.client.get(url, {'search': 'first'})
+        self.assertEqual([report['name'] for report in response.data], ['first'])
+
+    def test_report_copy(self):
+        user = User.objects.get(username='testy')
+        ct = ContentType.objects.get_for_model(Report)
+        report = Report.objects.create(name='template', root_model=ct, user_created=user)
+        report.starred.add(user, User.objects.create(username='other'))
+
+        def count_clone_queries(name):
+            with CaptureQueriesContext(connection) as queries:
+                report.clone(name=name)
+            return len(queries)
+
+        DisplayField.objects.create(report=report, field='name', field_verbose='name', position=0)
+        FilterField.objects.create(report=report, field='name', field_verbose='name', filter_value='a')
+        queries = count_clone_queries('region 1')
+        for position in range(1, 6):
+            DisplayField.objects.create(report=report, field='slug', field_verbose='slug', position=position)
+            FilterField.objects.create(report=report, field='slug', field_verbose='slug', filter_value='b')
+        self.assertEqual(count_clone_queries('region 2'), queries)
+
+        response = self.client.post(f'/report_builder/api/report/{report.id}/copy_report/')
+        self.assertEqual(response.status_code, 200)
+        new_report = Report.objects.get(pk=response.json()['id'])
+        self.assertEqual(new_report.name, 'template (copy)')
+        self.assertNotEqual(new_report.slug, report.slug)
+        self.assertEqual(len(response.json()['displayfield_set']), 6)
+        self.assertEqual(
+            [field['id'] for field in response.json()['displayfield_set']],
+            list(new_report.displayfield_set.values_list('pk', flat=True)),
+        )
+        self.assertEqual(new_report.filterfield_set.count(), 6)
+        self.assertEqual(set(new_report.starred.all()), set(report.starred.all()))
+
     def test_report_builder_fields(self):
         ct = ContentType.objects.get(model="foo", app_label="demo_models")
         response = self.client.post(
@@ -102,6 +204,51 @@ class ReportBuilderTests(TestCase):
         self.assertContains(response, 'char_field')
         self.assertNotContains(response, 'char_field2')
 
+    def test_report_builder_fields_etag(self):
+        ct = ContentType.objects.get(model="foo", app_label="demo_models")
+        params = {"model": ct.id, "field": ""}
+        response = self.client.get('/report_builder/api/fields/', params)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'char_field')
+        etag = response['ETag']
+        self.assertIn('private', response['Cache-Control'])
+
+        response = self.client.get('/report_builder/api/fields/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        response = self.client.get('/report_builder/api/related_fields/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # Formats are part of the config
+        response = self.client.get('/report_builder/api/config/')
+        etag = response['ETag']
+        response = self.client.get('/report_builder/api/config/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        Format.objects.create(name='money', string='${:,.2f}')
+        response = self.client.get('/report_builder/api/config/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'money')
+
+    @override_settings(REPORT_BUILDER_INCLUDE=None)
+    def test_report_builder_field_tree(self):
+        ct = ContentType.objects.get(model="bar", app_label="demo_models")
+        response = self.client.get('/report_builder/api/field_tree/', {"model": ct.id, "depth": 2})
+        self.assertEqual(response.status_code, 200)
+        tree = response.data
+        self.assertIn('i_want_char_field', [field['name'] for field in tree['fields']])
+        foos = next(relation for relation in tree['relations'] if relation['field_name'] == 'foos')
+        self.assertEqual(foos['children']['path'], 'foos__')
+        self.assertEqual([field['name'] for field in foos['children']['fields']], ['char_field'])
+        self.assertEqual(foos['children']['fields'][0]['path'], 'foos__')
+        # Foo relates back to Bar, which is already expanded
+        bar_set = next(relation for relation in foos['children']['relations'] if relation['field_name'] == 'bar_set')
+        self.assertTrue(bar_set['cycle'])
+        self.assertIsNone(bar_set['children'])
+
+        response = self.client.get('/report_builder/api/field_tree/', {"model": ct.id, "depth": 0})
+        foos = next(relation for relation in response.data['relations'] if relation['field_name'] == 'foos')
+        self.assertIsNone(foos['children'])
+
     def test_report_builder_fields_from_related(self):
         ct = ContentType.objects.get(model="place", app_label="demo_models")
         response = self.client.post(
@@ -228,6 +375,64 @@ class ReportBuilderTests(TestCase):
 
         self.assertIsNone(report.displayfield_set.all()[0].sort)
 
+    def test_report_nested_update_writes_changes_only(self):
+        ct = ContentType.objects.get_for_model(Report)
+        report = Report.objects.create(name="foo report", root_model=ct)
+        for position, field in enumerate(['name', 'slug', 'description']):
+            DisplayField.objects.create(report=report, field=field, field_verbose=field, name=field, position=position)
+        FilterField.objects.create(report=report, field='name', field_verbose='name', filter_value='foo')
+        data = ReportNestedSerializer(report).data
+        kept, changed, removed = data['displayfield_set']
+        changed['name'] = 'Slug'
+        data['displayfield_set'] = [
+            kept,
+            changed,
+            {'field': 'distinct', 'field_verbose': 'distinct', 'name': 'distinct', 'position': 2},
+        ]
+        data['filterfield_set'][0]['report'] = 0
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.put(
+                f'/report_builder/api/report/{report.id}/',
+                data=json.dumps(data),
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+        display_fields = list(report.displayfield_set.order_by('position'))
+        self.assertEqual([field.name for field in display_fields], ['name', 'Slug', 'distinct'])
+        self.assertEqual([field.pk for field in display_fields[:2]], [kept['id'], changed['id']])
+        self.assertFalse(DisplayField.objects.filter(pk=removed['id']).exists())
+        self.assertEqual(report.filterfield_set.get().pk, data['filterfield_set'][0]['id'])
+        writes = [
+            query['sql']
+            for query in queries.captured_queries
+            if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))
+            and ('report_builder_displayfield' in query['sql'] or 'report_builder_filterfield' in query['sql'])
+        ]
+        self.assertEqual(len(writes), 3)
+
+    def test_report_nested_update_formatted_fields(self):
+        ct = ContentType.objects.get_for_model(Report)
+        report = Report.objects.create(name="foo report", root_model=ct)
+        money = Format.objects.create(name='money', string='${:,.2f}')
+        for position in range(10):
+            DisplayField.objects.create(
+                report=report,
+                field='name',
+                field_verbose='name',
+                name='name',
+                position=position,
+                display_format=money,
+            )
+        data = json.dumps(ReportNestedSerializer(report).data)
+        url = f'/report_builder/api/report/{report.id}/'
+        # Fill the allowed models cache
+        self.client.put(url, data=data, content_type='application/json')
+        # Validation reads each format once, the update compares them by id
+        # and writes none of the unchanged fields
+        with self.assertNumQueries(22):
+            response = self.client.put(url, data=data, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
 
 class ReportTests(TestCase):
     def setUp(self):
@@ -863,6 +1068,294 @@ class ReportTests(TestCase):
             response = self.client.get(generate_url)
             self.assertEqual(len(response.data['data']), 2)
 
+    @override_settings(REPORT_BUILDER_INCLUDE=None, REPORT_BUILDER_EXCLUDE=('demo_models.person',))
+    def test_preview_unsaved_report(self):
+        self.make_people()
+        model = ContentType.objects.get(model='child', app_label="demo_models")
+        definition = {
+            'root_model': model.id,
+            'displayfield_set': [
+                {'field': 'age', 'field_verbose': 'age', 'name': 'Age', 'position': 1},
+                {'field': 'first_name', 'field_verbose': 'first name', 'name': 'Name', 'position': 0, 'sort': 1},
+                {'path': 'parent__', 'field': 'last_name', 'field_verbose': 'last name', 'name': 'Parent'},
+            ],
+            'filterfield_set': [
+                {'path': 'parent__', 'field': 'last_name', 'field_verbose': 'last name', 'filter_value': 'King'},
+            ],
+        }
+        reports = Report.objects.count()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('preview_report'), definition, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['meta']['titles'], ['Name', 'Age', 'Parent'])
+        expected = sorted(
+            Child.objects.filter(parent__last_name='King').values_list('first_name', 'age', 'parent__last_name'),
+            key=lambda row: row[0],
+        )
+        self.assertEqual(response.data['data'], [list(row) for row in expected])
+        self.assertEqual(Report.objects.count(), reports)
+        self.assertFalse([query for query in queries if query['sql'].startswith(('INSERT', 'UPDATE', 'DELETE'))])
+
+        definition['root_model'] = ContentType.objects.get_for_model(Person).id
+        response = self.client.post(reverse('preview_report'), definition, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('root_model', response.data)
+
+    @override_settings(REPORT_BUILDER_ASYNC_REPORT=False)
+    def test_freshness(self):
+        self.make_people()
+        model = ContentType.objects.get(model='person', app_label="demo_models")
+        report = Report.objects.create(root_model=model, name='People', freshness_field='birth_date')
+        DisplayField.objects.create(report=report, field='first_name', name='Name', position=0)
+        generate_url = reverse('generate_report', args=[report.id])
+        download_url = reverse('report_download_file', args=[report.id, 'csv'])
+
+        response = self.client.get(generate_url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertNotIn('Last-Modified', response)
+        response = self.client.get(generate_url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        # Only the ETag is validated, deleting the newest row would not change a date
+        response = self.client.get(generate_url, headers={'If-Modified-Since': 'Wed, 21 Oct 2099 07:28:00 GMT'})
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(download_url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get(download_url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # Deleted rows change the count
+        Person.objects.order_by('birth_date').first().delete()
+        response = self.client.get(generate_url, headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+        report.freshness_field = 'nope'
+        with self.assertRaises(ValidationError):
+            report.clean()
+
+    def test_diff_report_runs(self):
+        self.make_people()
+        user = User.objects.get(username='testy')
+        model = ContentType.objects.get(model='child', app_label="demo_models")
+        report = Report.objects.create(root_model=model, name='Kids')
+        DisplayField.objects.create(report=report, field='id', name='Id', position=0)
+        DisplayField.objects.create(report=report, field='first_name', name='Name', position=1)
+        DisplayField.objects.create(report=report, field='age', name='Age', position=2)
+        old_run = report.run_report('csv', user=user, asynchronous=True)
+
+        removed, changed = Child.objects.order_by('pk')[:2]
+        removed_pk = removed.pk
+        removed.delete()
+        changed.age = 99
+        changed.save()
+        added = Child.objects.create(parent=changed.parent, first_name='New', last_name='Kid', age=None)
+        new_run = report.run_report('xlsx', user=user, asynchronous=True)
+
+        url = reverse('diff_report', args=[report.id])
+        for params in ({'new': new_run.id}, {}):
+            response = self.client.get(url, {'key': 'Id', 'old': old_run.id, **params})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['counts']['added'], 1)
+            self.assertEqual(response.data['counts']['removed'], 1)
+            self.assertEqual(response.data['counts']['changed'], 1)
+            self.assertEqual(response.data['counts']['unchanged'], Child.objects.count() - 2)
+            self.assertEqual(response.data['added'][0][:2], [added.pk, 'New'])
+            self.assertEqual(response.data['removed'][0][0], str(removed_pk))
+            self.assertEqual(response.data['changed'][0]['columns'], ['Age'])
+            self.assertEqual(response.data['changed'][0]['new'][2], 99)
+
+        response = self.client.get(url, {'key': 'Age', 'old': old_run.id})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.get(url, {'key': 'Id', 'old': 0})
+        self.assertEqual(response.status_code, 404)
+
+    def test_stream_report(self):
+        self.make_people()
+        model = ContentType.objects.get(model='child', app_label="demo_models")
+        report = Report.objects.create(root_model=model, name='Kids')
+        DisplayField.objects.create(report=report, field='first_name', name='Name', position=0, sort=1)
+        DisplayField.objects.create(report=report, field='age', name='Age', position=1, total=True)
+
+        def read_events(report, page_size):
+            url = reverse('stream_report', args=[report.id])
+            response = self.client.get(url, {'page_size': page_size})
+            self.assertEqual(response['Content-Type'], 'text/event-stream')
+            events = []
+            for message in b''.join(response.streaming_content).decode().split('\n\n')[:-1]:
+                event, data = message.split('\n')
+                events.append((event.removeprefix('event: '), json.loads(data.removeprefix('data: '))))
+            return events
+
+        events = read_events(report, 4)
+        self.assertEqual(events[0], ('meta', {'titles': ['Name', 'Age']}))
+        rows = [row for event, data in events if event == 'rows' for row in data]
+        self.assertTrue(all(len(data) <= 4 for event, data in events if event == 'rows'))
+        expected = report.report_to_list()
+        self.assertEqual(rows, expected[:-2])
+        event, done = events[-1]
+        self.assertEqual(event, 'done')
+        self.assertEqual(done['rows'], Child.objects.count())
+        self.assertEqual(done['totals'], [str(total) for total in expected[-1]])
+
+        # Grouped reports are computed whole and then streamed
+        DisplayField.objects.filter(report=report, field='first_name').update(group=True)
+        events = read_events(report, 4)
+        rows = [row for event, data in events if event == 'rows' for row in data]
+        self.assertEqual(rows, report.report_to_list()[:-2])
+
+        def broken_pages(report, page_size):
+            yield [['Kennedy', 12]]
+            raise ValueError('broken')
+
+        with (
+            mock.patch.object(Report, 'iter_preview_pages', autospec=True, side_effect=broken_pages),
+            self.assertLogs('report_builder.api.views', 'ERROR'),
+        ):
+            events = read_events(report, 4)
+        self.assertEqual([event for event, data in events], ['meta', 'rows', 'error'])
+        self.assertEqual(events[-1][1], {'detail': 'The report failed.'})
+        self.assertEqual(ReportRun.objects.filter(report=report).latest('pk').status, ReportRun.ERROR)
+
+    @override_settings(REPORT_BUILDER_BATCH_WORKERS=1)
+    def test_generate_reports(self):
+        self.make_people()
+        model = ContentType.objects.get(model='child', app_label="demo_models")
+        kids = Report.objects.create(root_model=model, name='Kids')
+        DisplayField.objects.create(report=kids, field='first_name', name='Name', position=0, sort=1)
+        slow = Report.objects.create(root_model=model, name='Slow kids')
+        DisplayField.objects.create(report=slow, field='age', position=0)
+        url = reverse('generate_reports')
+
+        response = self.client.post(url, {'reports': [kids.id, 0], 'snapshot': True}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.data['snapshot'])  # PostgreSQL only
+        result = response.data['results'][str(kids.id)]
+        self.assertEqual(result['status'], 200)
+        self.assertEqual(result['data'], kids.report_to_list(preview=True))
+        self.assertEqual(result['meta'], {'titles': ['Name']})
+        self.assertGreaterEqual(result['elapsed'], 0)
+        self.assertEqual(response.data['results']['0']['status'], 404)
+
+        def report_to_list(report, *args, **kwargs):
+            if report.pk == slow.pk:
+                raise ReportTimeoutError('too slow')
+            return []
+
+        with mock.patch.object(Report, 'report_to_list', autospec=True, side_effect=report_to_list):
+            response = self.client.post(url, {'reports': [kids.id, slow.id]}, content_type='application/json')
+        self.assertEqual(response.data['results'][str(kids.id)]['status'], 200)
+        self.assertEqual(response.data['results'][str(slow.id)]['status'], 504)
+        self.assertEqual(ReportRun.objects.get(report=slow).status, ReportRun.TIMEOUT)
+
+        def broken_report_to_list(report, *args, **kwargs):
+            if report.pk == slow.pk:
+                raise ValueError('broken')
+            return []
+
+        with (
+            mock.patch.object(Report, 'report_to_list', autospec=True, side_effect=broken_report_to_list),
+            self.assertLogs('report_builder.api.views', 'ERROR'),
+        ):
+            response = self.client.post(url, {'reports': [slow.id, kids.id]}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][str(slow.id)]['status'], 500)
+        self.assertEqual(
+            response.data['results'][str(kids.id)], {'status': 200, 'data': [], 'meta': mock.ANY, 'elapsed': mock.ANY}
+        )
+        self.assertTrue(ReportRun.objects.filter(report=slow, status=ReportRun.ERROR).exists())
+
+        response = self.client.post(url, {'reports': 'all'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_generate_reports_snapshot_without_threads(self):
+        report = Report.objects.create(root_model=self.report.root_model, name='B')
+        DisplayField.objects.create(report=report, field='char_field', position=0)
+
+        @contextmanager
+        def export_snapshot(using):
+            yield 'snapshot-id'
+
+        with (
+            mock.patch('report_builder.api.views.export_snapshot', export_snapshot),
+            mock.patch(
+                'report_builder.api.views.use_snapshot',
+                return_value=nullcontext(),
+            ) as use_snapshot,
+        ):
+            response = self.client.post(
+                reverse('generate_reports'),
+                {'reports': [report.id], 'snapshot': True},
+                content_type='application/json',
+            )
+        self.assertTrue(response.data['snapshot'])
+        self.assertEqual(response.data['results'][str(report.id)]['data'], [['wooo']])
+        # The only report runs on the exporting connection, already in the snapshot
+        use_snapshot.assert_called_once_with(None, using='default')
+
+    def test_keyset_pagination(self):
+        self.make_people()
+        Child.objects.filter(first_name__in=['Will', 'Maria', 'Laura']).update(age=None)
+        model = ContentType.objects.get(model='child', app_label="demo_models")
+        report = Report.objects.create(root_model=model, name='Kids')
+        DisplayField.objects.create(report=report, field='first_name', position=0)
+        age = DisplayField.objects.create(report=report, field='age', position=1, sort=1, sort_reverse=True)
+        DisplayField.objects.create(report=report, path='parent__', field='last_name', position=2, sort=2)
+        DisplayField.objects.create(report=report, field='color', position=3)
+        generate_url = reverse('generate_report', args=[report.id])
+
+        def read_pages(page_size):
+            rows = []
+            params = {'page_size': page_size}
+            while True:
+                response = self.client.get(generate_url, params)
+                self.assertEqual(response.status_code, 200)
+                self.assertLessEqual(len(response.data['data']), page_size)
+                rows += response.data['data']
+                if not response.data['next']:
+                    return rows
+                params['cursor'] = response.data['next']
+
+        def expected(reverse):
+            children = sorted(Child.objects.select_related('parent'), key=lambda child: child.pk)
+            children.sort(key=lambda child: child.parent.last_name)
+            # Nulls come first ascending and last descending
+            children.sort(key=lambda child: (child.age is not None, child.age or 0), reverse=reverse)
+            return [[c.first_name, c.age, c.parent.last_name, c.color] for c in children]
+
+        self.assertEqual(read_pages(3), expected(reverse=True))
+        age.sort_reverse = False
+        age.save()
+        self.assertEqual(read_pages(4), expected(reverse=False))
+
+        response = self.client.get(generate_url, {'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, 400)
+        DisplayField.objects.create(report=report, path='parent__', field='id', position=4, aggregate='Count')
+        response = self.client.get(generate_url, {'page_size': 3})
+        self.assertEqual(response.status_code, 400)
+
+    def test_keyset_page_formats(self):
+        for status in (Bar.MATE, 'XX', ''):
+            Bar.objects.create(char_field='7', check_mate_status=status)
+        DisplayField.objects.create(report=self.report, field='check_mate_status', position=0)
+        DisplayField.objects.create(
+            report=self.report,
+            field='char_field',
+            position=1,
+            display_format=Format.objects.create(name='money', string='${:,.2f}'),
+        )
+        page, next_cursor = self.report.get_keyset_page()
+        self.assertIsNone(next_cursor)
+        self.assertEqual(page[1:], [['MA', '$7.00'], ['XX', '$7.00'], ['', '$7.00']])
+        rows, message = DataExportMixin().report_to_list(
+            self.report.get_query().order_by('pk'),
+            self.report.get_good_display_fields(),
+        )
+        self.assertEqual(page, rows)
+        self.assertEqual(page, self.report.report_to_list())
+
     def test_groupby_id(self):
         self.make_people()
 
@@ -917,6 +1410,42 @@ class ReportTests(TestCase):
 
         self.assertContains(response, data)
 
+    def test_groupby_summary(self):
+        self.make_people()
+
+        model = ContentType.objects.get(model='child', app_label="demo_models")
+        report = Report.objects.create(root_model=model, name='Kids per parent')
+        DisplayField.objects.create(report=report, path='parent__', field='id', position=0, group=True)
+        DisplayField.objects.create(report=report, field='id', position=1, aggregate='Count')
+        DisplayField.objects.create(report=report, field='age', position=2, aggregate='Sum')
+        DisplayField.objects.create(report=report, field='age', position=3, aggregate='Avg')
+        DisplayField.objects.create(report=report, field='age', position=4, aggregate='Max')
+
+        def live_rows():
+            return sorted(report.report_to_list(report.get_query()))
+
+        expected = live_rows()
+        summary = ReportSummary.objects.create(report=report, watermark_field='id')
+        self.assertEqual(sorted(report.report_to_list()), expected)
+        summary.refresh_from_db()
+        self.assertEqual(summary.watermark, Child.objects.order_by('-id').first().id)
+
+        # Only the new row is aggregated and merged in
+        parent = Person.objects.get(first_name='Maria')
+        Child.objects.create(parent=parent, first_name='Ann', last_name='Smith', age=20)
+        expected = live_rows()
+        self.assertEqual(sorted(report.report_to_list()), expected)
+        objects_list, message = DataExportMixin().report_to_list(
+            report.get_query(),
+            report.get_good_display_fields(),
+            grouped_rows=report.get_summary_rows(report.get_good_display_fields()),
+        )
+        self.assertEqual(sorted(objects_list), expected)
+
+        # A changed definition rebuilds the summary
+        DisplayField.objects.create(report=report, field='age', position=5, aggregate='Min')
+        self.assertEqual(sorted(report.report_to_list()), live_rows())
+
     def test_groupby_name(self):
         self.make_people()
 
@@ -1389,3 +1918,263 @@ class ReportTests(TestCase):
         settings.REPORT_BUILDER_ASYNC_REPORT = True
         response = self.client.get('/report_builder/api/config/')
         self.assertContains(response, '"async_report": true')
+
+    @override_settings(REPORT_BUILDER_ARTIFACT_MAX_AGE=60)
+    def test_reuse_report_run(self):
+        DisplayField.objects.create(
+            report=self.report,
+            field="char_field",
+            field_verbose="stuff",
+        )
+        first_run = self.report.run_report('xlsx', scheduled=True)
+        second_run = self.report.run_report('xlsx', scheduled=True)
+        self.assertEqual(first_run, second_run)
+        self.assertEqual(ReportRun.objects.filter(report=self.report).count(), 1)
+        self.assertEqual(first_run.row_count, 1)
+
+        # A changed definition can not reuse the stored file
+        DisplayField.objects.create(
+            report=self.report,
+            field="check_mate_status",
+            field_verbose="stuff",
+        )
+        third_run = self.report.run_report('xlsx', scheduled=True)
+        self.assertNotEqual(first_run, third_run)
+
+    @override_settings(REPORT_BUILDER_ARTIFACT_RETENTION=2)
+    def test_report_run_retention(self):
+        DisplayField.objects.create(
+            report=self.report,
+            field="char_field",
+            field_verbose="stuff",
+        )
+        for _i in range(3):
+            self.report.run_report('csv', scheduled=True)
+        runs = ReportRun.objects.filter(report=self.report)
+        self.assertEqual(runs.count(), 3)
+        self.assertEqual(runs.exclude(report_file='').count(), 2)
+        self.report.refresh_from_db()
+        self.assertEqual(self.report.report_file.name, runs.first().report_file.name)
+
+    @override_settings(REPORT_BUILDER_TRACE_MEMORY=True)
+    def test_report_run_metrics(self):
+        DisplayField.objects.create(report=self.report, field="char_field", field_verbose="stuff", position=0, sort=1)
+        DisplayField.objects.create(report=self.report, field="i_want_char_field", field_verbose="stuff", position=1)
+        Bar.objects.create(char_field="b")
+        user = User.objects.get(username='testy')
+
+        self.report.run_report('csv', user)
+        run = ReportRun.objects.get(report=self.report)
+        self.assertEqual((run.trigger, run.status, run.user), (ReportRun.DOWNLOAD, ReportRun.SUCCESS, user))
+        self.assertEqual(run.row_count, 2)
+        self.assertGreater(run.byte_count, 0)
+        self.assertGreater(run.query_count, 0)
+        self.assertGreater(run.peak_memory, 0)
+        self.assertEqual(set(run.timings), {'query', 'properties', 'sort', 'format', 'encode'})
+        self.assertGreaterEqual(run.duration, sum(run.timings.values()))
+
+        self.report.run_report('csv', user, asynchronous=True)
+        run = ReportRun.objects.get(report=self.report, trigger=ReportRun.ASYNC)
+        self.assertTrue(run.report_file)
+        self.assertIn('store', run.timings)
+
+        self.client.get(self.generate_url)
+        with mock.patch.object(Report, 'report_to_list', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                self.client.get(self.generate_url)
+        previews = ReportRun.objects.filter(report=self.report, trigger=ReportRun.PREVIEW)
+        self.assertEqual([run.status for run in previews], [ReportRun.ERROR, ReportRun.SUCCESS])
+        self.assertEqual(previews[1].row_count, 2)
+
+        stats = ReportRun.get_stats()
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((stats[0]['report'], stats[0]['runs'], stats[0]['errors']), (self.report, 4, 1))
+        self.assertLessEqual(stats[0]['p50'], stats[0]['p95'])
+        # Only the latest runs are read
+        self.assertEqual(ReportRun.get_stats(limit=2)[0]['runs'], 2)
+        response = self.client.get(reverse('admin:report_builder_reportrun_stats'))
+        self.assertContains(response, self.report.name)
+
+        with freeze_time(timezone.now() + timedelta(days=91)):
+            report_builder_prune_run_history()
+        # The asynchronous run keeps its file
+        self.assertEqual(list(ReportRun.objects.values_list('trigger', flat=True)), [ReportRun.ASYNC])
+
+    @override_settings(REPORT_BUILDER_ARTIFACT_RETENTION=2, REPORT_BUILDER_ARTIFACT_MAX_AGE=60)
+    def test_report_run_retention_keeps_latest_file(self):
+        field = DisplayField.objects.create(report=self.report, field="char_field", field_verbose="stuff")
+        user = User.objects.get(username='testy')
+        self.report.run_report('csv', user, asynchronous=True)
+        latest_file = self.report.report_file.name
+        # Cached downloads store files without becoming the report's latest file
+        for i in range(3):
+            field.name = f'stuff {i}'
+            field.save()
+            self.report.run_report('csv', user)
+        self.report.refresh_from_db()
+        self.assertEqual(self.report.report_file.name, latest_file)
+        self.assertTrue(self.report.report_file.storage.exists(latest_file))
+        self.assertEqual(self.report.runs.exclude(report_file='').count(), 2)
+
+    @override_settings(REPORT_BUILDER_STATEMENT_TIMEOUT=1000)
+    def test_preview_statement_timeout(self):
+        self.report.statement_timeout = 5
+        self.report.save()
+        self.assertEqual(self.report.get_statement_timeout(), 5)
+        with mock.patch.object(Report, 'report_to_list', side_effect=ReportTimeoutError('too slow')):
+            response = self.client.get(self.generate_url)
+        self.assertEqual(response.status_code, 504)
+        self.assertEqual(response.data['detail'], 'too slow')
+        self.assertEqual(ReportRun.objects.get(report=self.report).status, ReportRun.TIMEOUT)
+
+    def test_rows_in_blocks(self):
+        Bar.objects.create(char_field="b")
+        Bar.objects.create(char_field="c")
+        values_list = Bar.objects.order_by('pk').values_list('pk', 'char_field')
+        rows = list(DataExportMixin().iter_row_blocks(values_list, Bar, {}, load_objects=True, block_size=2))
+        self.assertEqual([row for row, custom_values, objects in rows], list(values_list))
+        self.assertEqual([custom_values for row, custom_values, objects in rows], [{}, {}, {}])
+        self.assertEqual([len(objects) for row, custom_values, objects in rows], [2, 2, 1])
+
+    @mock.patch.object(Bar, 'get_custom_field', CustomFieldModel.get_custom_field, create=True)
+    def test_custom_fields(self):
+        ct = ContentType.objects.get_for_model(Bar)
+        nickname = CustomField.objects.create(name='nickname', content_type=ct)
+        bars = [Bar.objects.create(char_field=str(i)) for i in range(3)]
+        CustomFieldValue.objects.create(field=nickname, object_id=bars[0].pk, value='x')
+        CustomFieldValue.objects.create(field=nickname, object_id=bars[1].pk, value='y')
+        DisplayField.objects.create(report=self.report, field='char_field', position=0)
+        DisplayField.objects.create(report=self.report, field='nickname', position=1)
+        self.assertEqual(self.report.displayfield_set.get(field='nickname').field_type, 'Custom Field')
+
+        with self.assertNumQueries(1):
+            values = load_custom_values(Bar, ['nickname'], [self.bar.pk] + [bar.pk for bar in bars])
+        self.assertEqual(values, {(bars[0].pk, 'nickname'): 'x', (bars[1].pk, 'nickname'): 'y'})
+
+        def download():
+            rows, message = DataExportMixin().report_to_list(
+                self.report.get_query().order_by('pk'),
+                self.report.get_good_display_fields(),
+            )
+            return rows
+
+        self.assertEqual(download(), [['wooo', None], ['0', 'x'], ['1', 'y'], ['2', None]])
+        # Missing values are not created by reading them
+        self.assertEqual(CustomFieldValue.objects.count(), 2)
+
+        filter_field = FilterField.objects.create(
+            report=self.report,
+            field='nickname',
+            filter_type='exact',
+            filter_value='x',
+        )
+        self.assertEqual(download(), [['0', 'x']])
+        filter_field.exclude = True
+        filter_field.save()
+        self.assertEqual(download(), [['wooo', None], ['1', 'y'], ['2', None]])
+
+    def test_generic_foreign_key_property(self):
+        ct = ContentType.objects.get(model="comment", app_label="demo_models")
+        report = Report.objects.create(root_model=ct, name="Comments")
+        DisplayField.objects.create(report=report, field='commented_on', position=0)
+        self.assertEqual(report.displayfield_set.get().field_type, 'Property')
+
+        def count_queries():
+            with CaptureQueriesContext(connection) as preview:
+                preview_rows = report.report_to_list(report.get_query())
+            with CaptureQueriesContext(connection) as download:
+                download_rows, message = DataExportMixin().report_to_list(
+                    report.get_query(),
+                    report.get_good_display_fields(),
+                )
+            self.assertEqual(sorted(preview_rows), sorted(download_rows))
+            return len(preview), len(download)
+
+        Comment.objects.create(content_object=self.bar)
+        Comment.objects.create(content_object=Place.objects.create(name="a", address="b"))
+        queries = count_queries()
+        for i in range(3):
+            Comment.objects.create(content_object=Bar.objects.create(char_field=str(i)))
+            Comment.objects.create(content_object=Place.objects.create(name=str(i), address="b"))
+        self.assertEqual(count_queries(), queries)
+        self.assertIn(['a the place'], report.report_to_list(report.get_query()))
+
+    def test_explain_report(self):
+        DisplayField.objects.create(report=self.report, field='char_field', position=0)
+        DisplayField.objects.create(report=self.report, path='foos__', field='char_field', position=1)
+        FilterField.objects.create(report=self.report, field='char_field', filter_type='exact', filter_value='wooo')
+        self.assertEqual(self.report.get_to_many_paths(), ['foos__'])
+
+        response = self.client.get(reverse('explain_report', args=[self.report.id]), {'analyze': '1'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('demo_models_bar', response.data['sql'])
+        self.assertEqual(response.data['params'], ['wooo'])
+        self.assertTrue(response.data['plan'])
+        warnings = response.data['warnings']
+        self.assertIn('EXPLAIN ANALYZE is not supported', warnings[0])
+        self.assertTrue(any('Full scan of demo_models_bar' in warning for warning in warnings))
+        self.assertTrue(any('Joining foos' in warning for warning in warnings))
+
+    @override_settings(REPORT_BUILDER_DATABASE='replica')
+    def test_report_database(self):
+        self.assertEqual(self.report.get_query().db, 'replica')
+        self.report.database = 'default'
+        self.assertEqual(self.report.get_query().db, 'default')
+        self.report.database = 'does_not_exist'
+        with self.assertRaises(ValidationError):
+            self.report.clean()
+
+
+class GenerateReportsThreadTests(TransactionTestCase):
+    """Worker threads only see committed data, so these do not run in a transaction"""
+
+    def setUp(self):
+        user = User.objects.create(username='testy', is_staff=True, is_superuser=True)
+        self.client = APIClient()
+        self.client.force_login(user)
+        ct = ContentType.objects.get(model="bar", app_label="demo_models")
+        self.reports = []
+        for name in ('A', 'B', 'C'):
+            report = Report.objects.create(root_model=ct, name=name)
+            DisplayField.objects.create(report=report, field='char_field', position=0)
+            self.reports.append(report)
+        Bar.objects.create(char_field="wooo")
+
+    @override_settings(REPORT_BUILDER_BATCH_WORKERS=2, REPORT_BUILDER_TRACE_MEMORY=True)
+    def test_generate_reports_in_threads(self):
+        @contextmanager
+        def export_snapshot(using):
+            yield 'snapshot-id'
+
+        # SQLite's shared in-memory test database fails concurrent writes instead of waiting
+        save = ReportRun.save
+        save_lock = threading.Lock()
+
+        def locked_save(run, *args, **kwargs):
+            with save_lock:
+                save(run, *args, **kwargs)
+
+        report_ids = [report.id for report in self.reports]
+        with (
+            mock.patch.object(ReportRun, 'save', locked_save),
+            mock.patch('report_builder.api.views.export_snapshot', export_snapshot),
+            mock.patch(
+                'report_builder.api.views.use_snapshot',
+                return_value=nullcontext(),
+            ) as use_snapshot,
+        ):
+            response = self.client.post(
+                reverse('generate_reports'),
+                {'reports': report_ids, 'snapshot': True},
+                content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.data['results']), [str(pk) for pk in report_ids])
+        for result in response.data['results'].values():
+            self.assertEqual((result['status'], result['data']), (200, [['wooo']]))
+        # Workers have their own connections and import the snapshot
+        self.assertEqual(use_snapshot.call_args_list, [mock.call('snapshot-id', using='default')] * 3)
+        runs = ReportRun.objects.filter(trigger=ReportRun.PREVIEW)
+        self.assertEqual(runs.count(), 3)
+        # Process wide memory tracing can not tell the workers apart
+        self.assertFalse(runs.exclude(peak_memory=None).exists())
@@ -42,11 +42,41 @@ urlpatterns = [
         staff_member_required(api_views.FieldsView.as_view()),
         name="fields",
     ),
+    path(
+        'api/field_tree/',
+        staff_member_required(api_views.FieldTreeView.as_view()),
+        name="field_tree",
+    ),
     path(
         'api/report/<int:report_id>/generate/',
         staff_member_required(api_views.GenerateReport.as_view()),
         name="generate_report",
     ),
+    path(
+        'api/report/<int:report_id>/diff/',
+        staff_member_required(api_views.DiffReport.as_view()),
+        name="diff_report",
+    ),
+    path(
+        'api/report/<int:report_id>/stream/',
+        staff_member_required(api_views.StreamReport.as_view()),
+        name="stream_report",
+    ),
+    path(
+        'api/generate/',
+        staff_member_required(api_views.GenerateReports.as_view()),
+        name="generate_reports",
+    ),
+    path(
+        'api/preview/',
+        staff_member_required(api_views.PreviewReport.as_view()),
+        name="preview_report",
+    ),
+    path(
+        'api/report/<int:report_id>/explain/',
+        staff_member_required(api_views.ExplainReport.as_view()),
+        name="explain_report",
+    ),
     path(
         'api/report/<int:pk>/download_file/<path:filetype>/',
         views.DownloadFileView.as_view(),
@@ -1,13 +1,34 @@
 import copy
+import csv
 import datetime
+import hashlib
 import inspect
-from decimal import Decimal
+import io
+import math
+import re
+import threading
+import time
+import tracemalloc
+import zipfile
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
 from itertools import chain
 from numbers import Number
 
+from django.apps import apps
 from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import FieldDoesNotExist
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+from django.utils.cache import get_conditional_response, patch_cache_control
+from openpyxl import load_workbook
+
+
+class ReportTimeoutError(Exception):
+    """A report ran longer than its statement timeout"""
 
 
 def javascript_date_format(python_date_format):
@@ -28,18 +49,22 @@ def duplicate(obj, changes=None):
         raise ValueError('Instance must be saved before it can be cloned.')
     duplicate = copy.copy(obj)
     duplicate.pk = None
+    # Related objects prefetched for obj are not the copy's
+    duplicate.__dict__.pop('_prefetched_objects_cache', None)
     for change in changes:
         duplicate.__setattr__(change[0], change[1])
     duplicate.save()
-    # trick to copy ManyToMany relations.
+    # Copy ManyToMany relations with one insert each
     for field in obj._meta.many_to_many:
-        source = getattr(obj, field.attname)
-        destination = getattr(duplicate, field.attname)
-        for item in source.all():
-            try:  # m2m, through fields will fail.
-                destination.add(item)
-            except:
-                pass
+        through = field.remote_field.through
+        if not through._meta.auto_created:
+            continue  # Through models may need more than the two keys
+        source_name = field.m2m_field_name()
+        target_name = field.m2m_reverse_field_name()
+        target_ids = through.objects.filter(**{source_name: obj}).values_list(f'{target_name}_id', flat=True)
+        through.objects.bulk_create(
+            [through(**{source_name: duplicate, f'{target_name}_id': target_id}) for target_id in target_ids],
+        )
     return duplicate
 
 
@@ -115,6 +140,267 @@ def formatter(value, style):
         return value
 
 
+def get_row_formats(display_fields):
+    """Choice lists and display formats of display_fields, keyed by position"""
+    choice_lists = {}
+    display_formats = {}
+    for display_field in display_fields:
+        if display_field.choices and hasattr(display_field, 'choices_dict'):
+            choice_list = display_field.choices_dict
+            # Insert blank and None as valid choices.
+            choice_list[''] = ''
+            choice_list[None] = ''
+            choice_lists[display_field.position] = choice_list
+        if getattr(display_field, 'display_format', None):
+            display_formats[display_field.position] = display_field.display_format
+    return choice_lists, display_formats
+
+
+def format_row(row, choice_lists, display_formats):
+    """Replace choice values of row with their display string, then apply
+    display formats. row is changed in place.
+    """
+    for position, choice_list in choice_lists.items():
+        try:
+            row[position] = str(choice_list[row[position]])
+        except Exception:
+            row[position] = str(row[position])
+    for position, style in display_formats.items():
+        row[position] = formatter(row[position], style)
+    return row
+
+
+def _is_timeout_error(error, vendor):
+    cause = error.__cause__
+    if vendor == 'postgresql':
+        # query_canceled, psycopg2 and psycopg 3 name it differently
+        return '57014' in (getattr(cause, 'pgcode', None), getattr(cause, 'sqlstate', None))
+    if vendor == 'mysql':
+        return bool(getattr(cause, 'args', None)) and cause.args[0] == 3024
+    return False
+
+
+_trace_memory_lock = threading.Lock()
+_current_run_metrics = ContextVar('report_builder_run_metrics', default=None)
+
+
+class RunMetrics:
+    """Timings and sizes of one report run, collected by Report.track_run.
+    Code deep in a run reaches them with run_stage and get_run_metrics.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, trace_memory=True):
+        self.using = using
+        self.trace_memory = trace_memory
+        self.timings = {}
+        self.duration = None
+        self.row_count = None
+        self.byte_count = None
+        self.query_count = 0
+        self.peak_memory = None
+        # Run stored by the block, updated instead of adding another
+        self.run = None
+
+    def add(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def count_query(self, execute, sql, params, many, context):
+        self.query_count += 1
+        return execute(sql, params, many, context)
+
+    @contextmanager
+    def collect(self):
+        """Make these the metrics of the current run while the block runs.
+        Blocks collected one after the other add up.
+
+        Peak memory is only traced with REPORT_BUILDER_TRACE_MEMORY, as it
+        slows everything down. tracemalloc covers the whole process, so one
+        run traces at a time and its peak includes allocations of other
+        threads, such as concurrent requests.
+        """
+        trace_memory = (
+            self.trace_memory
+            and getattr(settings, 'REPORT_BUILDER_TRACE_MEMORY', False)
+            and _trace_memory_lock.acquire(blocking=False)
+        )
+        if trace_memory and tracemalloc.is_tracing():
+            # Traced by something else, its start is not ours to reset
+            _trace_memory_lock.release()
+            trace_memory = False
+        if trace_memory:
+            tracemalloc.start()
+        token = _current_run_metrics.set(self)
+        started = time.perf_counter()
+        try:
+            with connections[self.using].execute_wrapper(self.count_query):
+                yield self
+        finally:
+            self.duration = (self.duration or 0) + time.perf_counter() - started
+            _current_run_metrics.reset(token)
+            if trace_memory:
+                self.peak_memory = max(self.peak_memory or 0, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+                _trace_memory_lock.release()
+
+
+def get_run_metrics():
+    """RunMetrics of the run in progress, None outside of a tracked run"""
+    return _current_run_metrics.get()
+
+
+def run_stage(name):
+    """Time the block as stage name of the run in progress, if any"""
+    metrics = _current_run_metrics.get()
+    return metrics.stage(name) if metrics else nullcontext()
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of sorted values, None when empty"""
+    if not values:
+        return None
+    return values[max(math.ceil(len(values) * fraction) - 1, 0)]
+
+
+@contextmanager
+def statement_timeout(timeout, using=DEFAULT_DB_ALIAS):
+    """Abort queries run in this block after timeout milliseconds.
+    PostgreSQL uses SET LOCAL statement_timeout and MySQL max_execution_time,
+    both per statement. SQLite is interrupted once the whole block runs over.
+    Other databases are not limited.
+    Raises ReportTimeoutError.
+    """
+    if not timeout:
+        yield
+        return
+    timeout = int(timeout)
+    message = f'Report exceeded the statement timeout of {timeout} ms'
+    connection = connections[using]
+    vendor = connection.vendor
+
+    if vendor == 'postgresql':
+        with transaction.atomic(using=using):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", [str(timeout)])
+            try:
+                yield
+            except OperationalError as e:
+                if _is_timeout_error(e, vendor):
+                    raise ReportTimeoutError(message) from e
+                raise
+    elif vendor == 'mysql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT @@SESSION.max_execution_time')
+            previous = cursor.fetchone()[0]
+            cursor.execute('SET SESSION max_execution_time = %s', [timeout])
+        try:
+            yield
+        except OperationalError as e:
+            if _is_timeout_error(e, vendor):
+                raise ReportTimeoutError(message) from e
+            raise
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('SET SESSION max_execution_time = %s', [previous])
+    elif vendor == 'sqlite':
+        connection.ensure_connection()
+        deadline = time.monotonic() + timeout / 1000
+        # A true return value interrupts the running statement
+        connection.connection.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        try:
+            yield
+        except OperationalError as e:
+            if time.monotonic() > deadline:
+                raise ReportTimeoutError(message) from e
+            raise
+        finally:
+            connection.connection.set_progress_handler(None, 1000)
+    else:
+        yield
+
+
+@contextmanager
+def export_snapshot(using=DEFAULT_DB_ALIAS):
+    """Hold a repeatable read transaction on PostgreSQL and yield the id of
+    its snapshot. Other connections pass it to use_snapshot to read the same
+    data while the block runs. Yields None on other databases or when a
+    transaction is already open.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql' or connection.in_atomic_block:
+        yield None
+        return
+    with transaction.atomic(using=using):
+        with connection.cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute('SELECT pg_export_snapshot()')
+            snapshot = cursor.fetchone()[0]
+        yield snapshot
+
+
+@contextmanager
+def use_snapshot(snapshot, using=DEFAULT_DB_ALIAS):
+    """Run the block in a repeatable read transaction on a snapshot from
+    export_snapshot. Does nothing when snapshot is None.
+    """
+    if snapshot is None:
+        yield
+        return
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', [snapshot])
+        yield
+
+
+# Postgres: "Seq Scan on table  (cost=0.00..1.00 rows=10 width=4)"
+PG_SEQ_SCAN_RE = re.compile(r'Seq Scan on (?P<table>\S+).*?rows=(?P<rows>\d+)')
+# SQLite: "SCAN table" without an index, unlike "SEARCH table USING INDEX"
+SQLITE_SCAN_RE = re.compile(r'\bSCAN (?:TABLE )?(?P<table>\w+)(?! USING (?:COVERING )?INDEX)')
+SORT_SPILL_RE = re.compile(r'Sort Method: external|USE TEMP B-TREE FOR ORDER BY|Using filesort')
+
+
+def explain_queryset(queryset, analyze=False):
+    """Return the SQL, query plan and plan warnings of a queryset.
+    analyze runs the query (EXPLAIN ANALYZE) on databases that support it.
+    """
+    sql, params = queryset.query.sql_with_params()
+    warnings = []
+    plan = None
+    if analyze:
+        try:
+            plan = queryset.explain(analyze=True)
+        except ValueError:
+            warnings.append('EXPLAIN ANALYZE is not supported on this database, showing the estimated plan.')
+    if plan is None:
+        plan = queryset.explain()
+
+    threshold = getattr(settings, 'REPORT_BUILDER_EXPLAIN_SEQ_SCAN_ROWS', 10000)
+    for match in PG_SEQ_SCAN_RE.finditer(plan):
+        if int(match.group('rows')) >= threshold:
+            warnings.append(
+                'Sequential scan on {} (about {} rows). An index on the filtered fields may help.'.format(
+                    match.group('table'),
+                    match.group('rows'),
+                ),
+            )
+    if queryset.db and connections[queryset.db].vendor == 'sqlite':
+        for match in SQLITE_SCAN_RE.finditer(plan):
+            warnings.append(
+                'Full scan of {}. An index on the filtered fields may help.'.format(match.group('table')),
+            )
+    if SORT_SPILL_RE.search(plan):
+        warnings.append('Sorting does not fit in memory and uses temporary storage.')
+    return {'sql': sql, 'params': [str(param) for param in params], 'plan': plan, 'warnings': warnings}
+
+
 # Model Utils
 
 
@@ -180,27 +466,70 @@ def get_direct_fields_from_model(model_class):
     return direct_fields
 
 
+def get_generic_foreign_keys(model_class):
+    """Names of a model's GenericForeignKey fields"""
+    return [field.name for field in model_class._meta.private_fields if isinstance(field, GenericForeignKey)]
+
+
+_custom_fields = {}
+
+
 def get_custom_fields_from_model(model_class):
-    """django-custom-fields support"""
+    """django-custom-fields support
+    Custom fields are cached per model until a custom field is saved or deleted.
+    """
     if 'custom_field' in settings.INSTALLED_APPS:
         from custom_field.models import CustomField
 
-        try:
-            content_type = ContentType.objects.get(
-                model=model_class._meta.model_name,
-                app_label=model_class._meta.app_label,
-            )
-        except ContentType.DoesNotExist:
-            content_type = None
-        custom_fields = CustomField.objects.filter(content_type=content_type)
-        return custom_fields
+        content_type = ContentType.objects.get_for_model(model_class, for_concrete_model=False)
+        if content_type.pk not in _custom_fields:
+            _custom_fields[content_type.pk] = list(CustomField.objects.filter(content_type=content_type))
+        return _custom_fields[content_type.pk]
+
+
+def clear_custom_fields_cache(**kwargs):
+    _custom_fields.clear()
+
+
+def get_custom_field_values(model_class, field_names, using=DEFAULT_DB_ALIAS):
+    """CustomFieldValue queryset of the named custom fields of a model"""
+    from custom_field.models import CustomFieldValue
+
+    content_type = ContentType.objects.get_for_model(model_class, for_concrete_model=False)
+    return CustomFieldValue.objects.using(using).filter(
+        field__content_type=content_type,
+        field__name__in=list(field_names),
+    )
+
+
+def load_custom_values(model_class, field_names, object_ids, using=DEFAULT_DB_ALIAS):
+    """Load custom field values of many objects in one query.
+    Returns a dict keyed by (object_id, field name). Missing values are left out.
+    """
+    values = get_custom_field_values(model_class, field_names, using=using).filter(object_id__in=object_ids)
+    return {
+        (object_id, name): value for object_id, name, value in values.values_list('object_id', 'field__name', 'value')
+    }
 
 
 def get_model_from_path_string(root_model, path):
     """Return a model class for a related model
     root_model is the class of the initial model
     path is like foo__bar where bar is related to foo
+    Results are memoized once the app registry is ready, until migrations
+    run or report builder settings change.
     """
+    if apps.ready:
+        return _cached_resolve_path_string(root_model, path)
+    return _resolve_path_string(root_model, path)
+
+
+def get_models_from_path_strings(root_model, paths):
+    """Return a dict of path to model class for several paths of root_model"""
+    return {path: get_model_from_path_string(root_model, path) for path in set(paths)}
+
+
+def _resolve_path_string(root_model, path):
     for path_section in path.split('__'):
         if path_section:
             try:
@@ -224,3 +553,146 @@ def get_model_from_path_string(root_model, path):
                 else:
                     root_model = field.model
     return root_model
+
+
+@lru_cache(maxsize=4096)
+def _cached_resolve_path_string(root_model, path):
+    return _resolve_path_string(root_model, path)
+
+
+def clear_path_string_cache():
+    _cached_resolve_path_string.cache_clear()
+
+
+def iter_file_rows(file, file_type, zipped=False):
+    """Yield the rows of a csv or xlsx report file. Zip files of parts are
+    read part by part, keeping only the first part's header.
+    """
+    if zipped:
+        with zipfile.ZipFile(file) as zip_file:
+            for index, name in enumerate(zip_file.namelist()):
+                with zip_file.open(name) as part:
+                    rows = iter_file_rows(part, file_type)
+                    if index > 0:
+                        next(rows, None)
+                    yield from rows
+        return
+    if file_type == 'csv':
+        yield from csv.reader(io.TextIOWrapper(file, encoding='utf-8', newline=''))
+    else:
+        workbook = load_workbook(file, read_only=True)
+        try:
+            for row in workbook.active.iter_rows(values_only=True):
+                yield list(row)
+        finally:
+            workbook.close()
+
+
+def diff_value(value):
+    """Comparable form of a cell read from csv, xlsx or the database"""
+    # csv files store None as 'None', xlsx files as an empty cell
+    if value is None or value == 'None':
+        return ''
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, Number):
+        value = str(value)
+    if isinstance(value, str):
+        try:
+            number = Decimal(value)
+        except InvalidOperation:
+            return value
+        return format(number.normalize(), 'f') if number.is_finite() else value
+    return str(value)
+
+
+def diff_rows(read_old, new_rows, key, limit=1000):
+    """Compare two tables by the column titled key with a hash join.
+
+    read_old returns a new iterator of the old rows, header first, because
+    the old side is read twice. new_rows is read once. Only the old keys with
+    a digest of their row are kept in memory, plus up to limit rows of each
+    kind of difference. Counts always cover every row.
+    Raises ValueError when the columns differ or key is not unique.
+    """
+
+    def digest(row):
+        return hashlib.blake2b(repr([diff_value(value) for value in row]).encode(), digest_size=16).digest()
+
+    old_rows = read_old()
+    header = [str(title) for title in next(old_rows, [])]
+    if key not in header:
+        raise ValueError(f'Unknown key column {key}.')
+    key_index = header.index(key)
+    digests = {}
+    for row in old_rows:
+        row_key = diff_value(row[key_index])
+        if row_key in digests:
+            raise ValueError(f'{key} is not unique in the old rows.')
+        digests[row_key] = digest(row)
+
+    new_rows = iter(new_rows)
+    if [str(title) for title in next(new_rows, [])] != header:
+        raise ValueError('The rows have different columns.')
+    counts = dict.fromkeys(('added', 'removed', 'changed', 'unchanged'), 0)
+    added = []
+    changed = {}
+    seen = set()
+    for row in new_rows:
+        row_key = diff_value(row[key_index])
+        if row_key in seen:
+            raise ValueError(f'{key} is not unique in the new rows.')
+        seen.add(row_key)
+        old_digest = digests.pop(row_key, None)
+        if old_digest is None:
+            counts['added'] += 1
+            if len(added) < limit:
+                added.append(list(row))
+        elif old_digest != digest(row):
+            counts['changed'] += 1
+            if len(changed) < limit:
+                changed[row_key] = list(row)
+        else:
+            counts['unchanged'] += 1
+    counts['removed'] = len(digests)
+
+    # Read the old side again for the rows that were removed or changed
+    removed = []
+    changes = []
+    old_rows = read_old()
+    next(old_rows, None)
+    for row in old_rows:
+        row_key = diff_value(row[key_index])
+        if row_key in digests and len(removed) < limit:
+            removed.append(list(row))
+        elif row_key in changed:
+            new_row = changed[row_key]
+            columns = [
+                title for title, old, new in zip(header, row, new_row, strict=False) if diff_value(old) != diff_value(new)
+            ]
+            changes.append({'key': new_row[key_index], 'old': list(row), 'new': new_row, 'columns': columns})
+    return {
+        'key': key,
+        'titles': header,
+        'added': added,
+        'removed': removed,
+        'changed': changes,
+        'counts': counts,
+        'truncated': max(counts['added'], counts['removed'], counts['changed']) > limit,
+    }
+
+
+def not_modified_response(request, etag):
+    """304 response when etag, from Report.get_freshness, matches the
+    If-None-Match header of request. None otherwise.
+    """
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        set_freshness_headers(response, etag)
+    return response
+
+
+def set_freshness_headers(response, etag):
+    response['ETag'] = etag
+    # Clients keep the results but check they are current before using them
+    patch_cache_control(response, private=True, no_cache=True)
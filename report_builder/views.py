@@ -1,4 +1,3 @@
-import copy
 import json
 
 from django.conf import settings
@@ -11,8 +10,8 @@ from django.utils.decorators import method_decorator
 from django.views.generic import TemplateView, View
 
 from .mixins import DataExportMixin
-from .models import Report
-from .utils import duplicate
+from .models import Report, ReportRun
+from .utils import ReportTimeoutError, not_modified_response, set_freshness_headers
 
 
 User = get_user_model()
@@ -63,9 +62,19 @@ class DownloadFileView(DataExportMixin, View):
         user = User.objects.get(pk=user_id)
 
         if to_response:
-            return report.run_report(file_type, user, queryset)
+            try:
+                freshness = None if queryset is not None else report.get_freshness(file_type, user)
+                not_modified = freshness and not_modified_response(self.request, freshness)
+                if not_modified:
+                    return not_modified
+                response = report.run_report(file_type, user, queryset)
+            except ReportTimeoutError as e:
+                return HttpResponse(str(e), status=504)
+            if freshness:
+                set_freshness_headers(response, freshness)
+            return response
         else:
-            report.run_report(file_type, user, queryset, asynchronous=True)
+            return report.run_report(file_type, user, queryset, asynchronous=True)
 
     def get(self, request, *args, **kwargs):
         report_id = kwargs['pk']
@@ -98,25 +107,11 @@ def ajax_add_star(request, pk):
 def create_copy(request, pk):
     """Copy a report including related fields"""
     report = get_object_or_404(Report, pk=pk)
-    new_report = duplicate(
-        report,
-        changes=(
-            ('name', f'{report.name} (copy)'),
-            ('user_created', request.user),
-            ('user_modified', request.user),
-        ),
+    new_report = report.clone(
+        name=f'{report.name} (copy)',
+        user_created=request.user,
+        user_modified=request.user,
     )
-    # duplicate does not get related
-    for display in report.displayfield_set.all():
-        new_display = copy.copy(display)
-        new_display.pk = None
-        new_display.report = new_report
-        new_display.save()
-    for report_filter in report.filterfield_set.all():
-        new_filter = copy.copy(report_filter)
-        new_filter.pk = None
-        new_filter.report = new_report
-        new_filter.save()
     return redirect(new_report)
 
 
@@ -167,7 +162,9 @@ def check_status(request, pk, task_id):
     link = ''
     if res.state == 'SUCCESS':
         report = get_object_or_404(Report, pk=pk)
-        link = report.report_file.url
+        # Prefer the run made by this task, report_file only holds the latest one
+        run = ReportRun.objects.filter(pk=res.result, report=report).exclude(report_file='').first()
+        link = run.report_file.url if run else report.report_file.url
     return HttpResponse(
         json.dumps(
             {
@@ -121,3 +121,7 @@ class Comment(models.Model):
     object_pk = models.TextField()
     content_object = GenericForeignKey(
         ct_field="content_type", fk_field="object_pk")
+
+    @property
+    def commented_on(self):
+        return str(self.content_object)
@@ -130,3 +130,9 @@ TESTING = len(sys.argv) > 1 and sys.argv[1] == 'test'
 if TESTING:
     DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3'}
     CELERY_ALWAYS_EAGER = True
+    # Test django-custom-field support. Its 3.0 release still imports this
+    # Python 2 helper, removed in Django 3.0.
+    from django.utils import encoding
+    if not hasattr(encoding, 'python_2_unicode_compatible'):
+        encoding.python_2_unicode_compatible = lambda klass: klass
+    INSTALLED_APPS += ('custom_field',)
@@ -7,9 +7,9 @@ from .models import ScheduledReport
 
 @admin.register(ScheduledReport)
 class ScheduledReportAdmin(admin.ModelAdmin):
-    list_display = ('report', 'is_active', 'last_run_at', 'run_report_url')
+    list_display = ('report', 'is_active', 'last_run_at', 'next_run_at', 'run_report_url')
     list_filter = ('is_active', 'last_run_at')
-    readonly_fields = ('last_run_at',)
+    readonly_fields = ('last_run_at', 'next_run_at')
 
     @admin.display(
         description='',
@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-19 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('report_builder_scheduled', '0002_auto_20180413_0747'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scheduledreport',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='scheduledreport',
+            index=models.Index(fields=['is_active', 'next_run_at'], name='report_buil_is_acti_e4b9e7_idx'),
+        ),
+    ]
@@ -1,10 +1,9 @@
 from django.conf import settings
 from django.db import models
+from django.db.models.signals import post_save
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-import report_builder_scheduled.tasks
-
 
 AUTH_USER_MODEL = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
@@ -48,10 +47,21 @@ class ScheduledReport(models.Model):
         verbose_name=_('crontab'),
         help_text=_('Use one of interval/crontab'),
     )
+    next_run_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['is_active', 'next_run_at'])]
 
     def __str__(self):
         return str(self.report)
 
+    def save(self, *args, **kwargs):
+        self.next_run_at = self.get_next_run_at()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = {*update_fields, 'next_run_at'}
+        super().save(*args, **kwargs)
+
     def _get_list_of_emails(self) -> [str]:
         """Get list of emails for all users to return"""
         emails = list(self.users.exclude(email="").values_list('email', flat=True))
@@ -69,16 +79,45 @@ class ScheduledReport(models.Model):
             return is_due
         return False
 
+    def get_next_run_at(self, last_run_at=None):
+        """When the report is next due after last_run_at, the earliest of the
+        interval and crontab schedules. None when neither is set.
+        """
+        last_run_at = last_run_at or self.last_run_at or timezone.now()
+        now = timezone.now()
+        next_runs = [
+            now + schedule.schedule.remaining_estimate(last_run_at)
+            for schedule in (self.interval, self.crontab)
+            if schedule
+        ]
+        return min(next_runs, default=None)
+
     def run_report(self):
-        self.report.run_report('xlsx', scheduled=True, email_to=self._get_list_of_emails())
-        self.last_run_at = timezone.now()
-        self.save()
+        self.run_together([self])
 
-    def run_from_schedule(self):
+    @staticmethod
+    def run_together(scheduled_reports):
+        """Run the report shared by scheduled_reports once and email the
+        file to the recipients of all of them
         """
+        (report,) = {scheduled.report for scheduled in scheduled_reports}
+        emails = [email for scheduled in scheduled_reports for email in scheduled._get_list_of_emails()]
+        report.run_report('xlsx', scheduled=True, email_to=list(dict.fromkeys(emails)))
+        last_run_at = timezone.now()
+        for scheduled in scheduled_reports:
+            scheduled.last_run_at = last_run_at
+            scheduled.save()
 
-        Run this only from a celery task - check if report needs to run and
-        if so run it as it's own celery task
-        """
-        if self._is_due():
-            report_builder_scheduled.tasks.report_builder_run_scheduled_report.delay(self.id)
+
+def update_next_run_at(sender, instance, **kwargs):
+    """Reschedule reports when their interval or crontab changes"""
+    for scheduled in instance.scheduledreport_set.all():
+        scheduled.save(update_fields=['next_run_at'])
+
+
+for schedule_model in ('django_celery_beat.IntervalSchedule', 'django_celery_beat.CrontabSchedule'):
+    post_save.connect(
+        update_next_run_at,
+        sender=schedule_model,
+        dispatch_uid=f'report_builder_scheduled_{schedule_model}',
+    )
@@ -1,4 +1,7 @@
 from celery import shared_task
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 
 import report_builder_scheduled.models
 
@@ -9,12 +12,48 @@ def report_builder_run_scheduled_report(scheduled_report_id: int):
     report.run_report()
 
 
+@shared_task
+def report_builder_run_scheduled_reports(scheduled_report_ids: [int]):
+    """Run scheduled reports of the same report once for all their recipients"""
+    scheduled_reports = report_builder_scheduled.models.ScheduledReport.objects.filter(pk__in=scheduled_report_ids)
+    scheduled_reports = list(scheduled_reports.select_related('report', 'interval', 'crontab'))
+    if scheduled_reports:
+        report_builder_scheduled.models.ScheduledReport.run_together(scheduled_reports)
+
+
 @shared_task
 def report_builder_check_if_scheduled_report():
     """
 
     Run any reports that need run - this will kick off another task for
     the actual reports - so this should always run pretty fast
+
+    Due reports are found on the indexed next_run_at and claimed by moving it
+    forward while their rows are locked, so concurrent checks skip them.
+    Reports saved before next_run_at existed are checked once the old way.
+    Schedules due for the same report run it once for all their recipients.
     """
-    for scheduled in report_builder_scheduled.models.ScheduledReport.objects.filter(is_active=True):
-        scheduled.run_from_schedule()
+    scheduled_reports = report_builder_scheduled.models.ScheduledReport.objects
+    now = timezone.now()
+    with transaction.atomic():
+        due = list(
+            scheduled_reports.filter(
+                Q(next_run_at__lte=now)
+                | Q(next_run_at__isnull=True) & (Q(interval__isnull=False) | Q(crontab__isnull=False)),
+                is_active=True,
+            )
+            .select_related('report', 'interval', 'crontab')
+            .select_for_update(skip_locked=True, of=('self',)),
+        )
+        by_report = {}
+        for scheduled in due:
+            if scheduled.next_run_at is None and not scheduled._is_due():
+                scheduled.next_run_at = scheduled.get_next_run_at()
+                continue
+            scheduled.next_run_at = scheduled.get_next_run_at(now)
+            by_report.setdefault(scheduled.report_id, []).append(scheduled.pk)
+        for pks in by_report.values():
+            transaction.on_commit(
+                lambda pks=pks: report_builder_run_scheduled_reports.delay(pks),
+            )
+        scheduled_reports.bulk_update(due, ['next_run_at'])
@@ -1,4 +1,5 @@
-from unittest import skipIf
+from datetime import timedelta
+from unittest import mock, skipIf
 
 import django
 from django.contrib.auth import get_user_model
@@ -6,11 +7,18 @@ from django.contrib.contenttypes.models import ContentType
 from django.core import mail
 from django.test import TestCase
 from django.urls import reverse
+from django.utils import timezone
+from django_celery_beat.models import IntervalSchedule
+from freezegun import freeze_time
 
 from report_builder.models import Report
 
 from .models import ScheduledReport
-from .tasks import report_builder_run_scheduled_report
+from .tasks import (
+    report_builder_check_if_scheduled_report,
+    report_builder_run_scheduled_report,
+    report_builder_run_scheduled_reports,
+)
 
 
 User = get_user_model()
@@ -36,6 +44,92 @@ class ScheduledReportTests(TestCase):
         self.assertIsNotNone(scheduled_report.report.report_file_creation)
         self.assertEqual(len(mail.outbox), 1)
 
+    def test_scheduled_reports_run_once(self):
+        ct = ContentType.objects.get(model="bar", app_label="demo_models")
+        report = Report.objects.create(root_model=ct, name="A")
+        other_report = Report.objects.create(root_model=ct, name="B")
+        hourly = IntervalSchedule.objects.create(every=1, period=IntervalSchedule.HOURS)
+        first = ScheduledReport.objects.create(report=report, interval=hourly, other_emails="a@example.com")
+        second = ScheduledReport.objects.create(
+            report=report,
+            interval=hourly,
+            other_emails="b@example.com, a@example.com",
+        )
+        other = ScheduledReport.objects.create(report=other_report, interval=hourly, other_emails="c@example.com")
+
+        delay = 'report_builder_scheduled.tasks.report_builder_run_scheduled_reports.delay'
+        with freeze_time(timezone.now() + timedelta(hours=2)), mock.patch(delay) as run:
+            with self.captureOnCommitCallbacks(execute=True):
+                report_builder_check_if_scheduled_report()
+        self.assertCountEqual(
+            [call.args[0] for call in run.call_args_list],
+            [[first.pk, second.pk], [other.pk]],
+        )
+
+        with mock.patch.object(Report, 'run_report', autospec=True) as run_report:
+            report_builder_run_scheduled_reports([first.pk, second.pk])
+        run_report.assert_called_once_with(
+            report,
+            'xlsx',
+            scheduled=True,
+            email_to=['a@example.com', 'b@example.com'],
+        )
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual(first.last_run_at, second.last_run_at)
+
+    def test_check_due_reports(self):
+        ct = ContentType.objects.get(model="bar", app_label="demo_models")
+        report = Report.objects.create(root_model=ct, name="A")
+        hourly = IntervalSchedule.objects.create(every=1, period=IntervalSchedule.HOURS)
+        scheduled_report = ScheduledReport.objects.create(report=report, interval=hourly)
+        unscheduled_report = ScheduledReport.objects.create(report=report)
+        self.assertAlmostEqual(
+            scheduled_report.next_run_at,
+            scheduled_report.last_run_at + timedelta(hours=1),
+            delta=timedelta(seconds=1),
+        )
+        self.assertIsNone(unscheduled_report.next_run_at)
+
+        delay = 'report_builder_scheduled.tasks.report_builder_run_scheduled_reports.delay'
+        with mock.patch(delay) as run:
+            with self.captureOnCommitCallbacks(execute=True):
+                report_builder_check_if_scheduled_report()
+            run.assert_not_called()
+
+            with freeze_time(timezone.now() + timedelta(minutes=90)):
+                with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(4):
+                    report_builder_check_if_scheduled_report()
+                run.assert_called_once_with([scheduled_report.pk])
+                scheduled_report.refresh_from_db()
+                self.assertAlmostEqual(
+                    scheduled_report.next_run_at,
+                    timezone.now() + timedelta(hours=1),
+                    delta=timedelta(seconds=1),
+                )
+                # Claimed reports are not due again until the next interval
+                run.reset_mock()
+                with self.captureOnCommitCallbacks(execute=True):
+                    report_builder_check_if_scheduled_report()
+                run.assert_not_called()
+
+            # Reports saved before next_run_at existed are scheduled on the first check
+            ScheduledReport.objects.update(next_run_at=None)
+            report_builder_check_if_scheduled_report()
+            run.assert_not_called()
+            scheduled_report.refresh_from_db()
+            self.assertIsNotNone(scheduled_report.next_run_at)
+
+        # Changing the schedule reschedules its reports
+        hourly.every = 2
+        hourly.save()
+        scheduled_report.refresh_from_db()
+        self.assertAlmostEqual(
+            scheduled_report.next_run_at,
+            scheduled_report.last_run_at + timedelta(hours=2),
+            delta=timedelta(seconds=1),
+        )
+
     @skipIf(IS_D18, "Django 1.8 does not support force_login")
     def test_run_scheduled_report_view(self):
         ct = ContentType.objects.get(model="bar", app_label="demo_models")